@@ -0,0 +1,4 @@
+""" Общие модули для утилит репозитория (sntp, dns-cashe, port_scan).
+Скрипты запускаются из своих каталогов, поэтому перед импортом добавляют
+корень репозитория в sys.path.
+"""
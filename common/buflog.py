@@ -0,0 +1,149 @@
+""" Буферизованный журнал с фоновым писателем.
+
+Горячий путь только кладет кортеж (формат, аргументы) в collections.deque -
+append/popleft у deque атомарны в CPython и не берут блокировок (см. test.py
+в корне: deque заметно быстрее queue.Queue). Форматирование и запись в
+поток выполняет отдельный поток-писатель раз в flush_interval секунд.
+
+Дополнительно:
+    sample(...)  - пишется только каждая N-я запись (1 из N)
+    client(addr) - считает обращения по клиентам, раз в window секунд
+        пишется сводка "адрес x число"; без окна - как sample
+    stamp=True   - префикс с временем записи (точность - flush_interval)
+
+Память ограничена: в очереди не больше max_records записей, в сводке за
+окно - не больше max_clients адресов. Если поток вывода не успевает за
+потоком записей, лишние отбрасываются и считаются, число отброшенного
+пишется в журнал.
+"""
+
+import atexit
+import collections
+import os
+import sys
+import threading
+import time
+
+TOP_CLIENTS = 10  # сколько клиентов показывать в сводке за окно
+MAX_RECORDS = 10000  # записей в очереди писателя
+MAX_CLIENTS = 10000  # разных адресов в сводке за одно окно
+
+
+class BufferedLog:
+    def __init__(self, stream=None, sample=1, window=0,
+                 flush_interval=0.2, stamp=False, max_records=MAX_RECORDS,
+                 max_clients=MAX_CLIENTS) -> None:
+        self.stream = stream or sys.stdout
+        self.stamp = stamp
+        self.sample_rate = max(1, sample)
+        self.window = window
+        self.flush_interval = flush_interval
+        self.records = collections.deque()
+        self.max_records = max_records
+        self.dropped = 0  # записей, не поместившихся в очередь
+        self.clients = {}
+        self.max_clients = max_clients
+        self.untracked = 0  # обращений адресов сверх max_clients
+        self.seen = 0
+        self.window_start = time.time()
+        self.writer = None
+        self.closed = False
+        self._start_writer()
+        atexit.register(self.close)
+        # поток-писатель не переживает fork, в дочернем процессе
+        # запускаем свой
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def log(self, msg, *args):
+        """ Запись без прореживания, msg форматируется в писателе """
+        if len(self.records) < self.max_records:
+            self.records.append((msg, args))
+        else:
+            self.dropped += 1
+
+    def sample(self, msg, *args):
+        """ Пишется одна запись из sample_rate """
+        self.seen += 1
+        if self.seen % self.sample_rate == 0:
+            self.log(msg, *args)
+
+    def client(self, addr):
+        """ Учет обращения клиента. Счетчики пишутся без блокировок:
+            обращение, учтенное в момент, когда писатель подменяет
+            словарь, может не попасть в сводку """
+        if not self.window:
+            self.sample("Connected: {}", addr)
+            return
+        clients = self.clients
+        count = clients.get(addr)
+        if count is not None:
+            clients[addr] = count + 1
+        elif len(clients) < self.max_clients:
+            clients[addr] = 1
+        else:
+            self.untracked += 1
+
+    def flush(self):
+        records = self.records
+        stream = self.stream
+        prefix = time.strftime('%Y-%m-%d %H:%M:%S ') if self.stamp else ''
+        # не больше, чем лежало в начале: иначе при непрерывном потоке
+        # записей flush не закончится
+        for _ in range(len(records)):
+            msg, args = records.popleft()
+            stream.write(prefix + (msg.format(*args) if args else msg) + '\n')
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            stream.write('{}log: {} records dropped, output too slow\n'
+                         .format(prefix, dropped))
+        if self.window and time.time() - self.window_start >= self.window:
+            self._write_clients()
+        stream.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer is not None and self.writer.is_alive():
+            self.writer.join(self.flush_interval * 2)
+        self.flush()
+
+    def _write_clients(self):
+        # подменяем словарь целиком: счетчики, попавшие в старый словарь
+        # во время подмены, могут потеряться - для сводки это допустимо
+        clients, self.clients = self.clients, {}
+        untracked, self.untracked = self.untracked, 0
+        spent = time.time() - self.window_start
+        self.window_start = time.time()
+        if not clients:
+            return
+        top = sorted(clients.items(), key=lambda item: -item[1])
+        self.stream.write(
+            'Clients in last {:.0f}s: {} requests from {}\n'.format(
+                spent, sum(clients.values()) + untracked, len(clients)))
+        if untracked:
+            self.stream.write('  {} requests from clients over the limit '
+                              'of {}\n'.format(untracked, self.max_clients))
+        for addr, count in top[:TOP_CLIENTS]:
+            self.stream.write('  {} x {}\n'.format(addr, count))
+        if len(top) > TOP_CLIENTS:
+            self.stream.write('  ... and {} more\n'.format(
+                len(top) - TOP_CLIENTS))
+
+    def _start_writer(self):
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _after_fork(self):
+        self.records.clear()
+        self.dropped = 0
+        self.clients = {}
+        self.untracked = 0
+        self.closed = False
+        self._start_writer()
+
+    def _write_loop(self):
+        while not self.closed:
+            time.sleep(self.flush_interval)
+            self.flush()
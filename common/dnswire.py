@@ -0,0 +1,554 @@
+""" Разбор и сборка DNS-сообщений (RFC 1035), общие для dns-cashe
+    и port_scan.
+
+    * один проход по memoryview, без срезов пакета и рекурсии;
+    * структуры заголовка, вопроса и записи скомпилированы заранее;
+    * указатели сжатия разворачиваются в цикле, число переходов
+      ограничено MAX_POINTERS - петля указателей не уронит сервер;
+    * имена возвращаются как b'mail.ru' и интернируются: одинаковые имена
+      из разных пакетов - один и тот же объект bytes;
+    * результат - объекты со __slots__, а не словари;
+    * любой некорректный пакет - исключение DNSError.
+
+rdata копируется в bytes (пакет обычно лежит в переиспользуемом буфере),
+имена внутри rdata типов NS/CNAME/PTR/MX/SOA разворачиваются в несжатый
+wire-формат, потому что указатели ссылаются на исходный пакет.
+
+Сборка:
+    * MessageBuilder пишет в заранее выделенный bytearray через
+      pack_into и срезовое присваивание, без конкатенации bytes;
+      после reset() буфер используется повторно;
+    * уже записанные суффиксы имен запоминаются со смещением
+      и заменяются указателем сжатия;
+    * wire-форма имени и список его суффиксов кэшируются (qname_wire):
+      повторные имена не режутся на метки заново;
+    * EDNS0 (RFC 6891): OPT-запись с размером UDP-буфера, чтобы большие
+      ответы приходили по UDP без TC=1 и повтора по TCP.
+"""
+
+import random
+import struct
+
+HEADER = struct.Struct('!6H')
+QUESTION = struct.Struct('!2H')
+RR_FIXED = struct.Struct('!HHIH')
+MX_PREFERENCE = struct.Struct('!H')
+POINTER = struct.Struct('!H')
+OPTION = struct.Struct('!HH')
+
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_PTR = 12
+TYPE_MX = 15
+TYPE_AAAA = 28
+TYPE_OPT = 41
+TYPE_ANY = 255
+CLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+ARCOUNT_OFFSET = 10
+SOA_FIXED_SIZE = 20  # serial, refresh, retry, expire, minimum
+MAX_POINTERS = 16
+MAX_NAME_LENGTH = 255
+MAX_LABEL_LENGTH = 63
+MAX_INTERNED = 1 << 16
+MAX_POINTER_OFFSET = 0x3FFF
+MAX_MESSAGE_SIZE = 65535  # предел TCP; для UDP обрезает отправитель
+
+UDP_PAYLOAD = 512  # без EDNS0 (RFC 1035, 4.2.1)
+FRAME_SIZE = 2  # длина перед сообщением в TCP (RFC 1035, 4.2.2)
+EDNS_VERSION = 0
+EDNS_PAYLOAD = 1232  # DNS flag day 2020: без фрагментации IP
+EDNS_FLAG_DO = 0x8000
+EDNS_OPT = 1  # режимы EDNS0 запроса для edns_mode
+EDNS_DO = 2
+
+_interned = {}
+_wire_names = {}
+
+
+class DNSError(ValueError):
+    """ Некорректное DNS-сообщение """
+
+
+def intern_name(name):
+    interned = _interned.get(name)
+    if interned is None:
+        if len(_interned) >= MAX_INTERNED:
+            _interned.clear()
+        interned = _interned[name] = name
+    return interned
+
+
+def read_name(view, offset, names=None):
+    """ Имя по смещению offset -> (b'mail.ru', смещение за именем).
+        names - словарь смещение -> имя в пределах одного сообщения:
+        указатель на уже прочитанное имя не разбирается повторно """
+    labels = []
+    start = offset
+    end = None
+    hops = 0
+    length_total = 0
+    while True:
+        length = view[offset]
+        if length >= 0xC0:
+            hops += 1
+            if hops > MAX_POINTERS:
+                raise DNSError('too many compression pointers')
+            if end is None:
+                end = offset + 2
+            offset = (length & 0x3F) << 8 | view[offset + 1]
+            if names is not None and offset in names:
+                suffix = names[offset]
+                labels.append(suffix)
+                length_total += len(suffix) + 1
+                break
+            continue
+        if length & 0xC0:
+            raise DNSError('unknown label encoding')
+        offset += 1
+        if length == 0:
+            break
+        length_total += length + 1
+        labels.append(view[offset:offset + length])
+        offset += length
+    if length_total > MAX_NAME_LENGTH:
+        raise DNSError('name too long')
+    name = intern_name(b'.'.join(labels))
+    if names is not None:
+        names[start] = name
+    return name, offset if end is None else end
+
+
+def qname_wire(name):
+    """ b'mail.ru' -> (b'\\x04mail\\x02ru\\x00',
+                       ((0, b'mail.ru'), (5, b'ru'))):
+        несжатая wire-форма и суффиксы (смещение в ней, имя в нижнем
+        регистре) для таблицы сжатия. Результат кэшируется """
+    cached = _wire_names.get(name)
+    if cached is not None:
+        return cached
+    stripped = name.rstrip(b'.')
+    labels = stripped.split(b'.') if stripped else []
+    wire = bytearray()
+    suffixes = []
+    for i, label in enumerate(labels):
+        if not 0 < len(label) <= MAX_LABEL_LENGTH:
+            raise DNSError('bad label in {!r}'.format(name))
+        suffixes.append((len(wire), b'.'.join(labels[i:]).lower()))
+        wire.append(len(label))
+        wire += label
+    wire.append(0)
+    if len(wire) > MAX_NAME_LENGTH:
+        raise DNSError('name too long')
+    if len(_wire_names) >= MAX_INTERNED:
+        _wire_names.clear()
+    cached = _wire_names[name] = bytes(wire), tuple(suffixes)
+    return cached
+
+
+def encode_name(name):
+    """ Несжатое имя в wire-формате: b'mail.ru' -> b'\\x04mail\\x02ru\\x00' """
+    return qname_wire(name)[0]
+
+
+def encode_option(code, data):
+    """ EDNS0-опция (RFC 6891, 6.1.2) для MessageBuilder.opt """
+    return OPTION.pack(code, len(data)) + data
+
+
+def read_options(rdata):
+    """ rdata OPT-записи -> [(код, данные), ...] """
+    options = []
+    offset = 0
+    while offset + OPTION.size <= len(rdata):
+        code, length = OPTION.unpack_from(rdata, offset)
+        offset += OPTION.size
+        options.append((code, bytes(rdata[offset:offset + length])))
+        offset += length
+    return options
+
+
+def _opt_bounds(record):
+    """ Начало OPT-записи, начало и конец её rdata в пакете. Имя OPT -
+        всегда корень (один нулевой байт), поэтому все считается от
+        смещения TTL """
+    rdata = record.ttl_offset + RR_FIXED.size - 4
+    return record.ttl_offset - 5, rdata, rdata + len(record.rdata)
+
+
+def set_option(data, message, code, value):
+    """ Пакет с EDNS0-опцией code (прежняя опция с этим кодом заменяется).
+        Нет OPT-записи - добавляется новая в конец секции AR """
+    option = encode_option(code, value)
+    opt = message.opt()
+    if opt is None:
+        packet = bytearray(data)
+        _add_arcount(packet, 1)
+        packet += b'\x00'
+        packet += RR_FIXED.pack(TYPE_OPT, EDNS_PAYLOAD, EDNS_VERSION << 16,
+                                len(option))
+        packet += option
+        return bytes(packet)
+    _, start, end = _opt_bounds(opt)
+    rdata = b''.join(encode_option(*kept)
+                     for kept in read_options(opt.rdata)
+                     if kept[0] != code) + option
+    packet = bytearray(data[:start])
+    struct.pack_into('!H', packet, start - 2, len(rdata))
+    return bytes(packet + rdata + data[end:])
+
+
+def remove_opt(data, message):
+    """ Пакет без OPT-записи (ответ клиенту, который EDNS0 не просил) """
+    opt = message.opt()
+    if opt is None:
+        return data
+    start, _, end = _opt_bounds(opt)
+    packet = bytearray(data[:start])
+    packet += data[end:]
+    _add_arcount(packet, -1)
+    return bytes(packet)
+
+
+def reply_to(query, response, questions_end):
+    """ Ответ с ID и секцией вопросов запроса (questions_end - её конец
+        в запросе): клиент, перемешавший регистр имени (DNS 0x20),
+        получит свое написание """
+    question = bytes(query[HEADER.size:questions_end])
+    if bytes(response[HEADER.size:questions_end]).lower() != \
+            question.lower():
+        return query[:2] + response[2:]
+    return query[:2] + response[2:HEADER.size] + question + \
+        response[questions_end:]
+
+
+def edns_mode(data, message):
+    """ Режим EDNS0 запроса: 0 - без OPT, EDNS_OPT, EDNS_OPT | EDNS_DO -
+        с битом DO. От него зависят OPT и RRSIG в ответе, поэтому он
+        входит в ключи кэша и склейки запросов. message - запрос, можно
+        разобранный без записей """
+    arcount = data[ARCOUNT_OFFSET] << 8 | data[ARCOUNT_OFFSET + 1]
+    if not arcount:
+        return 0
+    end = message.questions_end
+    if arcount == 1 and not any(data[6:ARCOUNT_OFFSET]) and \
+            len(data) >= end + 1 + RR_FIXED.size and \
+            data[end:end + 3] == b'\x00\x00\x29':
+        # обычный случай: единственная запись после вопроса - OPT
+        flags = data[end + 7] << 8 | data[end + 8]
+    else:
+        opt = parse_message(data).opt()
+        if opt is None:
+            return 0
+        flags = opt.ttl
+    return EDNS_OPT | (EDNS_DO if flags & EDNS_FLAG_DO else 0)
+
+
+def udp_payload(message):
+    """ Сколько байт ответа по UDP примет автор запроса (message -
+        запрос, разобранный целиком) """
+    opt = message.opt()
+    return UDP_PAYLOAD if opt is None else max(UDP_PAYLOAD, opt.rclass)
+
+
+def truncate(data, message):
+    """ Ответ, не поместившийся в UDP: заголовок с TC=1 и вопрос, без
+        записей - клиент переспросит по TCP (RFC 7766, 5) """
+    packet = bytearray(data[:message.questions_end])
+    struct.pack_into('!HHHHH', packet, 2, message.flags | FLAG_TC,
+                     message.qdcount, 0, 0, 0)
+    return bytes(packet)
+
+
+def _add_arcount(packet, delta):
+    arcount, = struct.unpack_from('!H', packet, ARCOUNT_OFFSET)
+    struct.pack_into('!H', packet, ARCOUNT_OFFSET, arcount + delta)
+
+
+def read_rdata(view, rtype, offset, rdlength, names=None):
+    """ rdata в несжатом виде """
+    if rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+        return encode_name(read_name(view, offset, names)[0])
+    if rtype == TYPE_MX:
+        return bytes(view[offset:offset + 2]) + \
+            encode_name(read_name(view, offset + 2, names)[0])
+    if rtype == TYPE_SOA:
+        mname, end = read_name(view, offset, names)
+        rname, end = read_name(view, end, names)
+        return encode_name(mname) + encode_name(rname) + \
+            bytes(view[end:end + SOA_FIXED_SIZE])
+    return bytes(view[offset:offset + rdlength])
+
+
+class Question:
+    __slots__ = ('name', 'qtype', 'qclass')
+
+    def __init__(self, name, qtype, qclass) -> None:
+        self.name = name
+        self.qtype = qtype
+        self.qclass = qclass
+
+    def key(self):
+        """ Ключ кэша: (имя в нижнем регистре, тип, класс) """
+        return self.name.lower(), self.qtype, self.qclass
+
+    def __repr__(self):
+        return 'Question({!r}, {}, {})'.format(
+            self.name, self.qtype, self.qclass)
+
+
+class Record:
+    __slots__ = ('name', 'rtype', 'rclass', 'ttl', 'rdata', 'ttl_offset')
+
+    def __init__(self, name, rtype, rclass, ttl, rdata, ttl_offset) -> None:
+        self.name = name
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.rdata = rdata
+        self.ttl_offset = ttl_offset  # где в пакете лежит поле TTL
+
+    def __repr__(self):
+        return 'Record({!r}, {}, {}, ttl={}, {!r})'.format(
+            self.name, self.rtype, self.rclass, self.ttl, self.rdata)
+
+
+class Message:
+    __slots__ = ('id', 'flags', 'qdcount', 'questions', 'questions_end',
+                 'answers', 'authorities', 'additionals')
+
+    def __init__(self, txid, flags, qdcount) -> None:
+        self.id = txid
+        self.flags = flags
+        self.qdcount = qdcount
+        self.questions = []
+        self.questions_end = HEADER.size
+        self.answers = []
+        self.authorities = []
+        self.additionals = []
+
+    @property
+    def is_response(self):
+        return bool(self.flags & 0x8000)
+
+    @property
+    def opcode(self):
+        return (self.flags & 0x7800) >> 11
+
+    @property
+    def is_authoritative(self):
+        return bool(self.flags & 0x0400)
+
+    @property
+    def is_truncated(self):
+        return bool(self.flags & FLAG_TC)
+
+    @property
+    def recursion_desired(self):
+        return bool(self.flags & 0x0100)
+
+    @property
+    def recursion_available(self):
+        return bool(self.flags & 0x0080)
+
+    @property
+    def rcode(self):
+        return self.flags & 0x000F
+
+    def records(self):
+        """ Записи всех трех секций подряд """
+        return self.answers + self.authorities + self.additionals
+
+    def opt(self):
+        """ OPT-псевдозапись EDNS0 из секции AR или None """
+        for record in self.additionals:
+            if record.rtype == TYPE_OPT:
+                return record
+        return None
+
+    def __repr__(self):
+        return 'Message(id={}, flags={:#06x}, questions={}, answers={}, ' \
+            'authorities={}, additionals={})'.format(
+                self.id, self.flags, self.questions, self.answers,
+                self.authorities, self.additionals)
+
+
+def _read_records(view, offset, count, records, names):
+    size = len(view)
+    for _ in range(count):
+        name, offset = read_name(view, offset, names)
+        rtype, rclass, ttl, rdlength = RR_FIXED.unpack_from(view, offset)
+        ttl_offset = offset + 4
+        offset += RR_FIXED.size
+        if offset + rdlength > size:
+            raise DNSError('rdata out of message')
+        records.append(Record(name, rtype, rclass, ttl,
+                              read_rdata(view, rtype, offset, rdlength,
+                                         names),
+                              ttl_offset))
+        offset += rdlength
+    return offset
+
+
+def parse_message(data, records=True):
+    """ Разбор сообщения из bytes/bytearray/memoryview.
+        records=False - только заголовок и вопросы (быстрый путь для
+        входящих запросов) """
+    # bytes читаем напрямую (срез bytes - одна аллокация под метку),
+    # bytearray и прочие буферы - через memoryview без копирования
+    view = data if isinstance(data, (bytes, memoryview)) \
+        else memoryview(data)
+    names = {}
+    try:
+        txid, flags, qdcount, ancount, nscount, arcount = \
+            HEADER.unpack_from(view)
+        message = Message(txid, flags, qdcount)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            name, offset = read_name(view, offset, names)
+            qtype, qclass = QUESTION.unpack_from(view, offset)
+            offset += QUESTION.size
+            message.questions.append(Question(name, qtype, qclass))
+        message.questions_end = offset
+        if records:
+            offset = _read_records(view, offset, ancount, message.answers,
+                                   names)
+            offset = _read_records(view, offset, nscount,
+                                   message.authorities, names)
+            _read_records(view, offset, arcount, message.additionals,
+                          names)
+    except (IndexError, struct.error) as e:
+        raise DNSError('truncated message: {}'.format(e))
+    return message
+
+
+class MessageBuilder:
+    """ Сборка DNS-пакета в переиспользуемом буфере со сжатием имен:
+        для каждого записанного суффикса имени запоминается его смещение
+        в пакете.
+
+        builder.reset()
+        builder.header(txid, flags, 1, 0, 0, 1)
+        builder.question(b'mail.ru', TYPE_MX)
+        builder.opt()
+        sock.send(builder.view())
+    """
+    def __init__(self, size=MAX_MESSAGE_SIZE) -> None:
+        self.buffer = bytearray(size)
+        self.offset = HEADER.size
+        self.names = {}
+
+    def reset(self):
+        self.offset = HEADER.size
+        self.names.clear()
+
+    def header(self, txid, flags, qdcount, ancount, nscount=0, arcount=0):
+        HEADER.pack_into(self.buffer, 0, txid, flags, qdcount, ancount,
+                         nscount, arcount)
+
+    def write(self, data):
+        end = self.offset + len(data)
+        if end > len(self.buffer):
+            raise DNSError('message too long')
+        self.buffer[self.offset:end] = data
+        self.offset = end
+
+    def pack(self, packer, *values):
+        end = self.offset + packer.size
+        if end > len(self.buffer):
+            raise DNSError('message too long')
+        packer.pack_into(self.buffer, self.offset, *values)
+        self.offset = end
+
+    def name(self, name):
+        wire, suffixes = qname_wire(name)
+        names = self.names
+        end = len(wire)
+        pointer = None
+        if names:
+            for position, suffix in suffixes:
+                pointer = names.get(suffix)
+                if pointer is not None:
+                    end = position
+                    break
+        start = self.offset
+        for position, suffix in suffixes:
+            if position >= end or start + position > MAX_POINTER_OFFSET:
+                break
+            names[suffix] = start + position
+        self.write(wire if pointer is None else wire[:end])
+        if pointer is not None:
+            self.pack(POINTER, 0xC000 | pointer)
+
+    def question(self, name, qtype, qclass=CLASS_IN):
+        self.name(name)
+        self.pack(QUESTION, qtype, qclass)
+
+    def record(self, name, rtype, rclass, ttl, rdata):
+        self.name(name)
+        start = self.offset
+        self.pack(RR_FIXED, rtype, rclass, ttl, 0)
+        self.rdata(rtype, rdata)
+        struct.pack_into('!H', self.buffer, start + 8,
+                         self.offset - start - RR_FIXED.size)
+
+    def rdata(self, rtype, rdata):
+        """ Имена внутри rdata сжимаются только для типов RFC 1035 """
+        if rtype in (TYPE_NS, TYPE_CNAME, TYPE_PTR):
+            self.name(read_name(rdata, 0)[0])
+        elif rtype == TYPE_MX:
+            self.write(rdata[:2])
+            self.name(read_name(rdata, 2)[0])
+        elif rtype == TYPE_SOA:
+            mname, offset = read_name(rdata, 0)
+            rname, offset = read_name(rdata, offset)
+            self.name(mname)
+            self.name(rname)
+            self.write(rdata[offset:offset + SOA_FIXED_SIZE])
+        else:
+            self.write(rdata)
+
+    def opt(self, payload=EDNS_PAYLOAD, ext_rcode=0, flags=0, options=()):
+        """ OPT-псевдозапись EDNS0: в классе - размер UDP-буфера,
+            в TTL - старшие биты RCODE, версия и флаги (DO).
+            options - уже закодированные encode_option """
+        data = b''.join(options)
+        self.write(b'\x00')
+        self.pack(RR_FIXED, TYPE_OPT, payload,
+                  ext_rcode << 24 | EDNS_VERSION << 16 | flags, len(data))
+        self.write(data)
+
+    def view(self):
+        """ Собранный пакет без копирования (до следующего reset) """
+        return memoryview(self.buffer)[:self.offset]
+
+    def getvalue(self):
+        return bytes(self.view())
+
+
+def encode_query(name, qtype=TYPE_A, qclass=CLASS_IN, txid=None,
+                 flags=FLAG_RD, payload=EDNS_PAYLOAD, edns_flags=0):
+    """ Запрос с одним вопросом: заголовок, закэшированная wire-форма
+        имени и OPT-запись (payload=0 - без EDNS0) с флагами edns_flags.
+        name - bytes или str """
+    if isinstance(name, str):
+        name = name.encode('idna')
+    if txid is None:
+        txid = random.getrandbits(16)
+    parts = [HEADER.pack(txid, flags, 1, 0, 0, 1 if payload else 0),
+             qname_wire(name)[0], QUESTION.pack(qtype, qclass)]
+    if payload:
+        parts.append(b'\x00')
+        parts.append(RR_FIXED.pack(TYPE_OPT, payload,
+                                   EDNS_VERSION << 16 | edns_flags, 0))
+    return b''.join(parts)
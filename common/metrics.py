@@ -0,0 +1,146 @@
+""" Метрики в формате Prometheus поверх заранее выделенного массива.
+
+Описание набора метрик (Metrics) задается один раз при импорте: каждая
+метрика получает смещение в плоском массиве 64-битных ячеек. Горячий путь
+- это только `cells[offset + i] += 1`, без словарей и блокировок.
+Массив ячеек может лежать в общей памяти (mmap), тогда один HTTP-эндпоинт
+суммирует ячейки нескольких процессов.
+
+    METRICS = Metrics()
+    REQUESTS = METRICS.counter('requests_total', 'Requests')
+    LATENCY = METRICS.histogram('latency_seconds', 'Latency', (0.001, 0.01))
+    cells = METRICS.allocate()
+    cells[REQUESTS] += 1
+    METRICS.observe(cells, LATENCY, 0.002)
+    serve_metrics(METRICS, [cells], 'localhost', 9100)
+"""
+
+import array
+import bisect
+import http.server
+import threading
+
+COUNTER, GAUGE, HISTOGRAM = 'counter', 'gauge', 'histogram'
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.layout = []
+        self.bounds = {}  # смещение гистограммы -> (границы, масштаб)
+        self.size = 0
+
+    def _add(self, kind, name, help, labels, size):
+        offset = self.size
+        self.layout.append((kind, name, help, labels, offset))
+        self.size += size
+        return offset
+
+    def counter(self, name, help, labels=None):
+        """ Счетчик; labels - список строк вида 'mode="3"', по ячейке на
+            каждую. Возвращает смещение первой ячейки """
+        labels = labels or ['']
+        return self._add(COUNTER, name, help, labels, len(labels))
+
+    def gauge(self, name, help, labels=None):
+        labels = labels or ['']
+        return self._add(GAUGE, name, help, labels, len(labels))
+
+    def histogram(self, name, help, bounds, scale=1e6, labels=None):
+        """ Гистограмма: ячейка на каждую границу, +Inf, сумма и
+            количество. Сумма хранится целым числом в 1/scale единицах.
+            С labels - такой блок на каждую метку подряд, i-й начинается
+            с offset + i * (len(bounds) + 3) """
+        labels = labels or ['']
+        stride = len(bounds) + 3
+        offset = self._add(HISTOGRAM, name, help, labels,
+                           stride * len(labels))
+        for i in range(len(labels)):
+            self.bounds[offset + i * stride] = (tuple(bounds), scale)
+        return offset
+
+    def allocate(self, buffer=None):
+        """ Ячейки метрик: новый массив или memoryview поверх buffer
+            (например, mmap размером не меньше size * 8 байт) """
+        if buffer is None:
+            return array.array('Q', bytes(8 * self.size))
+        return memoryview(buffer).cast('Q')[:self.size]
+
+    def observe(self, cells, offset, value):
+        """ Значение в гистограмму. Отрицательное (часы перевели назад
+            между двумя замерами time.time()) считается нулем: ячейки
+            беззнаковые """
+        value = max(0.0, value)
+        bounds, scale = self.bounds[offset]
+        cells[offset + bisect.bisect_left(bounds, value)] += 1
+        buckets = len(bounds) + 1
+        cells[offset + buckets] += int(value * scale)
+        cells[offset + buckets + 1] += 1
+
+    def render(self, cells_list):
+        """ Текстовый формат Prometheus, ячейки всех наборов суммируются """
+        total = [sum(values) for values in zip(*cells_list)] \
+            if cells_list else [0] * self.size
+        lines = []
+        for kind, name, help, labels, offset in self.layout:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if kind == HISTOGRAM:
+                stride = len(self.bounds[offset][0]) + 3
+                for i, label in enumerate(labels):
+                    self._render_histogram(lines, name, label,
+                                           offset + i * stride, total)
+                continue
+            for i, label in enumerate(labels):
+                lines.append('{}{} {}'.format(
+                    name, '{%s}' % label if label else '', total[offset + i]))
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, lines, name, label, offset, total):
+        bounds, scale = self.bounds[offset]
+        prefix = label + ',' if label else ''
+        series = '{%s}' % label if label else ''
+        cumulative = 0
+        for i, bound in enumerate(bounds + ('+Inf',)):
+            cumulative += total[offset + i]
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(
+                name, prefix, bound, cumulative))
+        buckets = len(bounds) + 1
+        lines.append('{}_sum{} {}'.format(
+            name, series, total[offset + buckets] / scale))
+        lines.append('{}_count{} {}'.format(
+            name, series, total[offset + buckets + 1]))
+
+
+def serve_metrics(metrics, cells_list, host, port, refresh=None,
+                  pages=None):
+    """ HTTP-эндпоинт /metrics в фоновом потоке, возвращает сервер.
+        refresh() вызывается перед каждой выдачей (например, чтобы
+        перенести в ячейки счетчики, которые ведутся в другом месте);
+        pages - дополнительные страницы: путь -> функция, отдающая
+        текст """
+    pages = dict(pages or {})
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in pages:
+                body = pages[self.path]().encode()
+            elif self.path == '/metrics':
+                if refresh is not None:
+                    refresh()
+                body = metrics.render(cells_list).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,156 @@
+""" Многопоточный бенчмарк кэша ответов:
+    прежний кэш raw_.py (одно соединение sqlite3 на все потоки)
+    против DNSCache под одной блокировкой и ShardedCache
+
+Каждый поток делает -n обращений к случайным ключам: get, при промахе
+put. В кэше заранее лежит доля --hit ключей. Разбор пакетов вынесен за
+замер - сравнивается только сам кэш. Печатается суммарная пропускная
+способность всех потоков.
+
+./bench_cache.py -n 20000 -t 1 2 4 8
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (TYPE_A, MessageBuilder,  # noqa: E402
+                            encode_query, parse_message)
+from dnscache import SHARDS, DNSCache, ShardedCache  # noqa: E402
+
+
+class LegacyCache:
+    """ Кэш из raw_.py: K - запрос без ID, V - ответ без ID """
+    def __init__(self) -> None:
+        # иначе соединение из другого потока не использовать
+        self.db = sqlite3.connect(':memory:', isolation_level=None,
+                                  check_same_thread=False)
+        cursor = self.db.cursor()
+        cursor.execute('CREATE TABLE IF NOT EXISTS T_CACHE \
+        (K BLOB PRIMARY KEY,V BLOB)')
+        cursor.execute('PRAGMA journal_mode = off')
+        cursor.close()
+
+    def get(self, K):
+        cursor = self.db.cursor()
+        try:
+            cursor.execute('SELECT V FROM T_CACHE WHERE K = ?', (K,))
+            return cursor.fetchall()[0][0]
+        except IndexError:
+            pass
+        finally:
+            cursor.close()
+
+    def put(self, K, V):
+        cursor = self.db.cursor()
+        try:
+            cursor.execute('INSERT INTO T_CACHE (K,V) VALUES (?,?)', (K, V))
+        except sqlite3.IntegrityError:
+            cursor.execute('UPDATE T_CACHE SET V = ? WHERE K = ?', (V, K))
+        finally:
+            cursor.close()
+
+
+class LockedCache:
+    """ Один DNSCache на все потоки под общей блокировкой """
+    def __init__(self, **options) -> None:
+        self.cache = DNSCache(**options)
+        self.lock = threading.Lock()
+
+    def get(self, key, txid, now=None):
+        with self.lock:
+            return self.cache.get(key, txid, now)
+
+    def put(self, key, response, message, now=None):
+        with self.lock:
+            return self.cache.put(key, response, message, now)
+
+
+def sample(index):
+    """ Запрос A и ответ на него для имени host<index>.example.com """
+    name = b'host%d.example.com' % index
+    query = encode_query(name, TYPE_A, txid=1, payload=0)
+    builder = MessageBuilder()
+    builder.header(1, 0x8180, 1, 1, 0, 0)
+    builder.question(name, TYPE_A, 1)
+    builder.record(name, TYPE_A, 1, 3600, bytes((10, 0, index >> 8 & 255,
+                                                 index & 255)))
+    response = builder.getvalue()
+    request = parse_message(query, records=False)
+    return query, response, request.questions[0].key(), \
+        parse_message(response)
+
+
+def legacy_worker(cache, samples, order):
+    for i in order:
+        query, response, _, _ = samples[i]
+        V = cache.get(query[2:])
+        if V:
+            b''.join([query[:2], V])
+        else:
+            cache.put(query[2:], response[2:])
+
+
+def cache_worker(cache, samples, order):
+    for i in order:
+        _, response, key, message = samples[i]
+        if cache.get(key, 1) is None:
+            cache.put(key, response, message)
+
+
+def run(threads, make, worker, samples, hit, number):
+    cache = make()
+    for i in range(int(len(samples) * hit)):
+        worker(cache, samples, (i,))
+    orders = [[random.Random(t).randrange(len(samples))
+               for _ in range(number)] for t in range(threads)]
+    pool = [threading.Thread(target=worker, args=(cache, samples, order))
+            for order in orders]
+    start = time.perf_counter()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return threads * number / (time.perf_counter() - start)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DNS cache benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Operations per thread')
+    parser.add_argument('-t', '--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8], help='Thread counts')
+    parser.add_argument('-k', '--keys', type=int, default=10000,
+                        help='Distinct names')
+    parser.add_argument('--hit', type=float, default=0.9,
+                        help='Share of names cached before the run')
+    parser.add_argument('--shards', type=int, default=SHARDS,
+                        help='ShardedCache shards')
+    return parser.parse_args().__dict__
+
+
+def bench(number: int, threads: list, keys: int, hit: float, shards: int):
+    samples = [sample(i) for i in range(keys)]
+    cases = (
+        ('sqlite ', LegacyCache, legacy_worker),
+        ('locked ', lambda: LockedCache(prefetch=0, max_stale=0),
+         cache_worker),
+        ('sharded', lambda: ShardedCache(shards, prefetch=0, max_stale=0),
+         cache_worker),
+    )
+    print('{} names, {:.0%} cached, {} ops per thread'.format(
+        keys, hit, number))
+    for name, make, worker in cases:
+        for count in threads:
+            rate = run(count, make, worker, samples, hit, number)
+            print('{} {:2d} threads {:10.0f} ops/s'.format(name, count, rate))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
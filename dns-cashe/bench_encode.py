@@ -0,0 +1,73 @@
+""" Бенчмарк сборки DNS-запроса:
+    прежний encode_dns_message (struct.pack на каждый символ и
+    конкатенация bytes) против common.dnswire (кэш wire-формы имени,
+    pack_into в переиспользуемый буфер)
+
+./bench_encode.py -n 20000
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (FLAG_RD, TYPE_A, MessageBuilder,  # noqa: E402
+                            encode_query)
+
+
+def legacy_encode(url):
+    randint = random.randint(0, 65535)
+    packet = struct.pack(">H", randint)
+    packet += struct.pack(">H", 0x0100)
+    packet += struct.pack(">H", 1)
+    packet += struct.pack(">H", 0)
+    packet += struct.pack(">H", 0)
+    packet += struct.pack(">H", 0)
+    for part in url.split("."):
+        packet += struct.pack("B", len(part))
+        for s in part:
+            packet += struct.pack('c', s.encode())
+    packet += struct.pack("B", 0)
+    packet += struct.pack(">H", 1)
+    packet += struct.pack(">H", 1)
+    return packet
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DNS encoder benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Iterations per case')
+    parser.add_argument('--name', type=str, default='mxs.mail.ru',
+                        help='Query name')
+    return parser.parse_args().__dict__
+
+
+def bench(number: int, name: str):
+    builder = MessageBuilder()
+    bname = name.encode()
+
+    def build():
+        builder.reset()
+        builder.header(1, FLAG_RD, 1, 0, 0, 1)
+        builder.question(bname, TYPE_A)
+        builder.opt()
+        return builder.view()
+
+    cases = (
+        ('legacy        ', lambda: legacy_encode(name)),
+        ('encode_query  ', lambda: encode_query(bname, payload=0)),
+        ('encode_query+E', lambda: encode_query(bname)),
+        ('builder+EDNS  ', build),
+    )
+    for title, case in cases:
+        spent = min(timeit.repeat(case, number=number, repeat=3))
+        print('{} {:8.2f} us/op {:10.0f} msg/s'.format(
+            title, spent / number * 1e6, number / spent))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
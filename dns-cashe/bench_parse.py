@@ -0,0 +1,106 @@
+""" Бенчмарк разбора DNS-сообщений:
+    прежний рекурсивный разбор (срезы, списки меток, словари)
+    против common.dnswire.parse_message (memoryview, __slots__)
+
+./bench_parse.py -n 20000
+"""
+
+import argparse
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (TYPE_A, TYPE_MX, MessageBuilder,  # noqa: E402
+                            encode_name, parse_message)
+
+
+def legacy_decode_labels(message, offset):
+    labels = []
+    while True:
+        length, = struct.unpack_from("!B", message, offset)
+        if (length & 0xC0) == 0xC0:
+            pointer, = struct.unpack_from("!H", message, offset)
+            offset += 2
+            return labels + legacy_decode_labels(
+                message, pointer & 0x3FFF)[0], offset
+        offset += 1
+        if length == 0:
+            return labels, offset
+        labels.append(*struct.unpack_from("!%ds" % length, message, offset))
+        offset += length
+
+
+def legacy_decode_records(message, offset, count):
+    records = []
+    for _ in range(count):
+        name, offset = legacy_decode_labels(message, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack_from(
+            "!HHIH", message, offset)
+        offset += struct.calcsize("!HHIH")
+        records.append({"name": name, "type": rtype, "class": rclass,
+                        "ttl": ttl,
+                        "rdata": message[offset:offset + rdlength]})
+        offset += rdlength
+    return records, offset
+
+
+def legacy_decode(message):
+    id, flags, qdcount, ancount, ns, ar = struct.unpack(
+        "!6H", message[:12])
+    offset = struct.calcsize("!6H")
+    questions = []
+    for _ in range(qdcount):
+        qname, offset = legacy_decode_labels(message, offset)
+        qtype, qclass = struct.unpack_from("!2H", message, offset)
+        offset += struct.calcsize("!2H")
+        questions.append({"domain_name": qname, "query_type": qtype,
+                          "query_class": qclass})
+    answers, offset = legacy_decode_records(message, offset, ancount)
+    authorities, offset = legacy_decode_records(message, offset, ns)
+    additionals, offset = legacy_decode_records(message, offset, ar)
+    return {"id": id, "flags": flags, "questions": questions,
+            "answers": answers, "authorities": authorities,
+            "additionals": additionals}
+
+
+def sample_response(servers):
+    """ Ответ на MX mail.ru: servers MX-записей и их A в секции AR """
+    builder = MessageBuilder()
+    builder.header(1, 0x8180, 1, servers, 0, servers)
+    builder.question(b'mail.ru', TYPE_MX, 1)
+    for i in range(servers):
+        builder.record(b'mail.ru', TYPE_MX, 1, 300, struct.pack('!H', 10) +
+                       encode_name(b'mxs%d.mail.ru' % i))
+    for i in range(servers):
+        builder.record(b'mxs%d.mail.ru' % i, TYPE_A, 1, 300,
+                       bytes((10, 0, 0, i)))
+    return builder.getvalue()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DNS parser benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Iterations per case')
+    return parser.parse_args().__dict__
+
+
+def bench(number: int):
+    query = sample_response(0)
+    response = sample_response(4)
+    cases = (
+        ('query    legacy ', lambda: legacy_decode(query)),
+        ('query    dnswire', lambda: parse_message(query, records=False)),
+        ('response legacy ', lambda: legacy_decode(response)),
+        ('response dnswire', lambda: parse_message(response)),
+    )
+    for name, case in cases:
+        spent = min(timeit.repeat(case, number=number, repeat=3))
+        print('{} {:8.2f} us/op {:10.0f} msg/s'.format(
+            name, spent / number * 1e6, number / spent))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
@@ -0,0 +1,212 @@
+""" Бенчмарк серверных схем: задержка и пропускная способность
+
+    threading  socketserver.ThreadingUDPServer - поток на датаграмму
+               (прежний raw_.py)
+    queue      поток приема, очередь и один поток ответов (прежний
+               dns-evil.py)
+    core       server.ServerCore: попадания отвечает поток приема,
+               промахи - пул обработчиков через ограниченную очередь
+
+Сервер запускается в отдельном процессе, клиент держит --window
+запросов в полете. Доля --hit имен лежит в кэше, остальные - промахи:
+обработчик спит --miss-delay секунд, как на ожидании форвардера (во
+всех схемах одинаково, хотя настоящий dns-evil.py ждет форвардера
+асинхронно). Печатаются запросы в секунду, медиана и 99-й процентиль
+задержки отдельно для попаданий и промахов, потерянные и SERVFAIL.
+
+./bench_server.py -n 20000 --window 64 --miss-delay 0.005
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (TYPE_A, MessageBuilder,  # noqa: E402
+                            encode_query, parse_message)
+from server import BACKLOG, WORKERS, ServerCore  # noqa: E402
+
+
+def answer(name):
+    builder = MessageBuilder()
+    builder.header(0, 0x8180, 1, 1, 0, 0)
+    builder.question(name, TYPE_A, 1)
+    builder.record(name, TYPE_A, 1, 300, bytes(4))
+    return builder.getvalue()
+
+
+class Backend:
+    """ Общая для всех схем логика: кэш-словарь и медленный промах """
+    def __init__(self, keys, hit, miss_delay) -> None:
+        self.cached = {}
+        for i in range(int(keys * hit)):
+            name = b'host%d.example.com' % i
+            self.cached[(name, TYPE_A, 1)] = answer(name)
+        self.miss_delay = miss_delay
+
+    def lookup(self, data, addr=None, now=None):
+        request = parse_message(data, records=False)
+        response = self.cached.get(request.questions[0].key())
+        if response is None:
+            return None
+        return data[:2] + response[2:]
+
+    def handle(self, data, addr=None, now=None, extra=None):
+        request = parse_message(data, records=False)
+        time.sleep(self.miss_delay)
+        return data[:2] + answer(request.questions[0].name)[2:]
+
+    def serve(self, data):
+        response = self.lookup(data)
+        return response if response is not None else self.handle(data)
+
+
+def run_threading(sock, backend, workers, backlog):
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            data, out = self.request
+            out.sendto(backend.serve(data), self.client_address)
+
+    server = socketserver.ThreadingUDPServer(sock.getsockname(), Handler,
+                                             bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def run_queue(sock, backend, workers, backlog):
+    tasks = queue.Queue()
+
+    def respond():
+        while True:
+            data, addr = tasks.get()
+            sock.sendto(backend.serve(data), addr)
+
+    threading.Thread(target=respond, daemon=True).start()
+    while True:
+        tasks.put(sock.recvfrom(1024))
+
+
+def run_core(sock, backend, workers, backlog):
+    ServerCore(sock, backend.lookup, backend.handle, workers=workers,
+               backlog=backlog).serve_forever()
+
+
+DESIGNS = {'threading': run_threading, 'queue': run_queue,
+           'core': run_core}
+
+
+def serve(design, sock, keys, hit, miss_delay, workers, backlog):
+    DESIGNS[design](sock, Backend(keys, hit, miss_delay), workers, backlog)
+
+
+def percentile(values, share):
+    if not values:
+        return float('nan')
+    values.sort()
+    return values[min(len(values) - 1, int(len(values) * share))] * 1e3
+
+
+def load(address, number, window, keys, hit, timeout):
+    """ Клиент: window запросов в полете, пока не отправит number """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    rand = random.Random(1)
+    outstanding = {}
+    latency = {True: [], False: []}
+    sent = lost = servfail = done = 0
+    start = time.perf_counter()
+    while done < number:
+        while len(outstanding) < window and sent < number:
+            index = rand.randrange(keys)
+            txid = sent & 0xFFFF
+            query = encode_query(b'host%d.example.com' % index, txid=txid,
+                                 payload=0)
+            outstanding[txid] = (time.perf_counter(), index < keys * hit)
+            sock.sendto(query, address)
+            sent += 1
+        try:
+            response = sock.recv(4096)
+        except socket.timeout:
+            lost += len(outstanding)
+            done += len(outstanding)
+            outstanding.clear()
+            continue
+        txid, flags = struct.unpack_from('!HH', response)
+        item = outstanding.pop(txid, None)
+        if item is None:
+            continue
+        done += 1
+        if flags & 0xF:
+            servfail += 1
+            continue
+        latency[item[1]].append(time.perf_counter() - item[0])
+    spent = time.perf_counter() - start
+    sock.close()
+    return number / spent, latency, lost, servfail
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='DNS server benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Queries per design')
+    parser.add_argument('-d', '--designs', nargs='+', default=list(DESIGNS),
+                        choices=list(DESIGNS), help='Designs to run')
+    parser.add_argument('--window', type=int, default=64,
+                        help='Queries in flight')
+    parser.add_argument('-k', '--keys', type=int, default=10000,
+                        help='Distinct names')
+    parser.add_argument('--hit', type=float, default=0.9,
+                        help='Share of names in cache')
+    parser.add_argument('--miss-delay', type=float, default=0.005,
+                        help='Seconds a miss waits for the forwarder')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='ServerCore workers')
+    parser.add_argument('--backlog', type=int, default=BACKLOG,
+                        help='ServerCore queue bound')
+    parser.add_argument('--timeout', type=float, default=2,
+                        help='Client receive timeout')
+    return parser.parse_args().__dict__
+
+
+def bench(number: int, designs: list, window: int, keys: int, hit: float,
+          miss_delay: float, workers: int, backlog: int, timeout: float):
+    print('{} queries, window {}, {:.0%} hits, miss {:.1f}ms'.format(
+        number, window, hit, miss_delay * 1e3))
+    print('{:9} {:>9} {:>15} {:>15} {:>6} {:>8}'.format(
+        'design', 'q/s', 'hit p50/p99 ms', 'miss p50/p99 ms', 'lost',
+        'servfail'))
+    for design in designs:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        server = multiprocessing.Process(
+            target=serve, args=(design, sock, keys, hit, miss_delay,
+                                workers, backlog), daemon=True)
+        server.start()
+        try:
+            rate, latency, lost, servfail = load(
+                sock.getsockname(), number, window, keys, hit, timeout)
+        finally:
+            server.terminate()
+            server.join()
+            sock.close()
+        hits, misses = latency[True], latency[False]
+        print('{:9} {:9.0f} {:7.2f}/{:<7.2f} {:7.2f}/{:<7.2f} {:6d} '
+              '{:8d}'.format(design, rate, percentile(hits, 0.5),
+                             percentile(hits, 0.99),
+                             percentile(misses, 0.5),
+                             percentile(misses, 0.99), lost, servfail))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
@@ -26,17 +26,34 @@
 """
 
 import argparse
+import gc
+import os
+import sys
 import threading
 import socket
-import queue
 import time
-import select
-import sqlite3
-import random
-import struct
+
+from dnscache import MAX_NEGATIVE, MAX_STALE, PREFETCH, DNSCache
+from dnsstats import (CACHE_PATH, MISS, PREFETCHED, RECORDS, STALE, TOP,
+                      UPSTREAM_PATH, QueryStats)
+from forwarder import Forwarder
+from loopguard import LoopGuard
+from snapshot import load as load_snapshot, save as save_snapshot
+from records import RecordStore, build_response
+from server import (BACKLOG, WORKERS, ServerCore, error_response,
+                    response_flags)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.dnswire import (EDNS_DO, EDNS_FLAG_DO,  # noqa: E402
+                            EDNS_OPT, EDNS_PAYLOAD, HEADER, RCODE_FORMERR,
+                            RCODE_SERVFAIL, DNSError, MessageBuilder,
+                            edns_mode, encode_query, parse_message)
 
 
 dns = (('8.8.8.8', 53), )
+SNAPSHOT_INTERVAL = 60
 
 
 def parse_args():
@@ -48,201 +65,329 @@ def parse_args():
         help='Прослушиваемый порт')
     parser.add_argument(
         '-f', '--forwarder',
-        type=str, default=['8.8.8.8:53'],
-        help='ip-адрес или символьное имя форвардера, c портом или без'
+        type=str, nargs='+', default=['8.8.8.8:53'],
+        help='ip-адреса или символьные имена форвардеров, c портом или без'
         )
+    parser.add_argument(
+        '--log-sample',
+        type=int, default=1,
+        help='Выводить каждое N-е сообщение о подключении')
+    parser.add_argument(
+        '--log-window',
+        type=float, default=0,
+        help='Раз в N секунд выводить сводку по клиентам')
+    parser.add_argument(
+        '--stats',
+        type=float, default=0,
+        help='Раз в N секунд выводить статистику кэша и форвардеров')
+    parser.add_argument(
+        '--prefetch',
+        type=float, default=PREFETCH,
+        help='Обновлять популярные записи, прожившие эту долю TTL '
+        '(0 - не обновлять)')
+    parser.add_argument(
+        '--max-stale',
+        type=float, default=MAX_STALE,
+        help='Сколько секунд отдавать устаревшие записи, если форвардер '
+        'недоступен (0 - не отдавать)')
+    parser.add_argument(
+        '--max-negative',
+        type=float, default=MAX_NEGATIVE,
+        help='Верхний предел TTL для NXDOMAIN и NODATA из кэша '
+        '(0 - не кэшировать отрицательные ответы)')
+    parser.add_argument(
+        '--snapshot',
+        type=str, default='',
+        help='Файл снимка кэша: читается при запуске, пишется периодически')
+    parser.add_argument(
+        '--snapshot-interval',
+        type=float, default=SNAPSHOT_INTERVAL,
+        help='Раз в N секунд сохранять снимок кэша')
+    parser.add_argument(
+        '--workers',
+        type=int, default=WORKERS,
+        help='Потоков-обработчиков промахов кэша')
+    parser.add_argument(
+        '--backlog',
+        type=int, default=BACKLOG,
+        help='Промахов в очереди, сверх этого запросы получают SERVFAIL')
+    parser.add_argument(
+        '--metrics-port',
+        type=int, default=0,
+        help='Отдавать метрики Prometheus на http://localhost:N/metrics, '
+        'частые имена - на /top (0 - не отдавать)')
+    parser.add_argument(
+        '--top',
+        type=int, default=TOP,
+        help='Сколько самых частых имен показывать на /top и в сводке')
 
     return parser.parse_args().__dict__
 
 
-def start(port: int, forwarder: str):
+def start(port: int, forwarder: list, log_sample: int, log_window: float,
+          stats: float, prefetch: float, max_stale: float,
+          max_negative: float, snapshot: str, snapshot_interval: float,
+          workers: int, backlog: int, metrics_port: int, top: int):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.bind(('localhost', port))
     s.settimeout(1)
-
-    sntp = DNSServer(s, forwarder)
+    # тот же порт по TCP: клиенты с обрезанным ответом (TC=1) и
+    # большие ответы (RFC 7766)
+    t = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    t.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    t.bind(('localhost', port))
+    t.listen(socket.SOMAXCONN)
+    t.settimeout(1)
+
+    log = BufferedLog(sample=log_sample, window=log_window)
+    cache = DNSCache(prefetch=prefetch, max_stale=max_stale,
+                     max_negative=max_negative)
+    sntp = DNSServer(s, forwarder, log, cache=cache, stats_interval=stats,
+                     snapshot=snapshot, snapshot_interval=snapshot_interval,
+                     workers=workers, backlog=backlog, stream=t,
+                     metrics_port=metrics_port, top=top)
     sntp.run()
 
 
-class Cache():
-    def __init__(self, filename=':memory:') -> None:
-        self.db = sqlite3.connect(filename, isolation_level=None)
-        self.db.text_factory = str
-        cursor = self.db.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS T_CACHE \
-            (K BLOB PRIMARY KEY,V BLOB)')
-        cursor.execute('PRAGMA journal_mode = off')
-        cursor.close()
-        pass
-
-    def get(self):
-        cursor = self.db.cursor()
-        a = cursor
-        a += a
-        return None
-
-    def put(self, K, V):
-        cursor = self.db.cursor()
-        a = cursor
-        a += a
-        pass
-
-
 class DNSServer:
     """
     * слушать порт
     * получив запрос проверить кэш - если в нём есть инфо - ответить
         по запросу, если нет - спросить у старшего, сохранить ответ,
         ответить по запросу
-    * многопоточность (1 слушать, 1 отвечать)
-    * если указанный старший не ответил, проверить у дефолтного или
-        сообщить об ошибке
+    * многопоточность (server.ServerCore): поток приема сам отвечает
+        из кэшей, промахи уходят в ограниченную очередь пула
+        обработчиков; кэши общие, под одной блокировкой
+    * если указанный старший не ответил, проверить у другого из списка
+        или сообщить об ошибке
+    * форвардеры опрашиваются асинхронно (forwarder.Forwarder),
+        обработчики не блокируются на медленном или упавшем старшем
+    * популярные записи обновляются до истечения TTL (prefetch), при
+        недоступном старшем отдаются устаревшие (serve-stale)
+    * кэш периодически сохраняется в снимок на диске и при запуске
+        подхватывается из него без разбора (snapshot.Snapshot, mmap)
+    * зацикливание (старший - это мы сами или наш же экземпляр)
+        обрывается SERVFAIL (loopguard.LoopGuard)
+    * TCP с обеих сторон (RFC 7766): клиенты - на том же порту,
+        обрезанные ответы старших переспрашиваются по постоянному
+        соединению к нему
     """
-    def __init__(self, s, forwarder) -> None:
+    def __init__(self, s, forwarder, log=None, cache=None,
+                 records=None, stats_interval=0, snapshot='',
+                 snapshot_interval=SNAPSHOT_INTERVAL, workers=WORKERS,
+                 backlog=BACKLOG, stream=None, metrics_port=0,
+                 top=TOP) -> None:
         self.s = s
-        self.forwarder = forwarder
-        self.task = queue.Queue()
+        if isinstance(forwarder, str):
+            forwarder = [forwarder]
+        # порядок не важен: Forwarder сам выбирает самого быстрого
+        self.forwarders = [parse_address(address) for address in forwarder] \
+            or list(dns)
+        self.log = log or BufferedLog()
+        self.cache = cache if cache is not None else DNSCache()
+        # отдельные записи из секций AN/NS/AR для самостоятельной сборки
+        self.records = records if records is not None else RecordStore()
+        # cache и records трогают поток приема и обработчики
+        self.lock = threading.Lock()
+        # буфер сборки ответов потока приема
+        self.builder = MessageBuilder()
+        self.core = ServerCore(s, self.lookup, self.handle, workers=workers,
+                               backlog=backlog, log=self.log, stream=stream)
+        self.guard = LoopGuard()
+        self.forwarder = Forwarder(self.forwarders, log=self.log,
+                                   guard=self.guard)
+        self.stats_interval = stats_interval
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.stats = QueryStats(top=top)
+        self.metrics_port = metrics_port
 
     def run(self):
-        print("DNS server start")
-        receiver = threading.Thread(target=self.listen)
-        receiver.start()
-        sender = threading.Thread(target=self.response)
-        sender.start()
-
-    def listen(self):
-        while True:
-            timeout = 3
-            ready_to_read, _, _ = select.select([self.sock], [], [], timeout)
-            if ready_to_read:
-                self.add_task(ready_to_read)
-
-    def add_task(self, ready_to_read):
-        for client in ready_to_read:
-            request, addr = client.recvfrom(1024)
-            print("Connected: {}".format(addr[0]))
-            self.task.put((request, addr, time.time()))
-
-    def response(self):
+        self.log.log("DNS server start")
+        if self.snapshot:
+            # теплый старт: записи снимка читаются из mmap по запросу
+            self.cache.attach(load_snapshot(self.snapshot, self.log))
+            if self.cache.snapshot is not None:
+                self.log.log('snapshot {}: {} entries',
+                             self.snapshot, len(self.cache.snapshot))
+        self.forwarder.start()
+        self.core.start()
+        if self.stats_interval > 0:
+            threading.Thread(target=self.print_stats, daemon=True).start()
+        if self.snapshot:
+            threading.Thread(target=self.save_snapshots, daemon=True).start()
+        if self.metrics_port:
+            self.stats.serve('localhost', self.metrics_port,
+                             self.update_stats)
+
+    def update_stats(self):
+        self.stats.update(self.forwarder, self.core, self.cache)
+
+    def save_snapshots(self):
+        """ Снимок пишется в своем потоке, поток ответов не ждет диска """
         while True:
+            time.sleep(self.snapshot_interval)
+            now = time.time()
+            # копия кэша - миллионы новых кортежей, на них сборщик мусора
+            # несколько раз обошел бы весь кэш целиком
+            collect = gc.isenabled()
+            gc.disable()
             try:
-                req, req_addr, req_time = self.task.get(timeout=1)
-                request = decode_dns_message(req)
-                # request.parse_package(req)  # разбираем запрос клиента
-                response = self.prepare_response(
-                    request, req_time).create_package()  # готовим ответ
-                self.sock.sendto(response, req_addr)  # отправляем
-            except queue.Empty:
+                count = save_snapshot(self.snapshot, self.cache.items(now),
+                                      now)
+            except OSError as e:
+                self.log.log('snapshot {} error: {}', self.snapshot, e)
                 continue
+            finally:
+                if collect:
+                    gc.enable()
+            self.log.log('snapshot {}: saved {} entries in {:.3f}s',
+                         self.snapshot, count, time.time() - now)
+
+    def print_stats(self):
+        """ Сводка раз в stats_interval секунд; счетчики читаются без
+            блокировок - для статистики гонки не страшны """
+        while True:
+            time.sleep(self.stats_interval)
+            self.log.log('cache {} answers {} rrsets {} bytes, forwarded '
+                         '{}, coalesced {} (saved upstream queries), '
+                         'loops {}', len(self.cache), len(self.records),
+                         self.cache.size, self.forwarder.forwarded,
+                         self.forwarder.coalesced, self.guard.loops)
+            self.log.log('{}', self.stats.summary())
+            self.log.log('answered inline {}, dispatched {}, rejected {}, '
+                         'queued {}, truncated {}, retried over TCP {}',
+                         self.core.inline, self.core.dispatched,
+                         self.core.rejected, self.core.tasks.qsize(),
+                         self.core.truncated, self.forwarder.truncated)
+            for upstream in self.forwarder.upstreams:
+                self.log.log('  forwarder {}', upstream)
+            for count, error, name in self.stats.hot_names(5):
+                self.log.log('  hot {} {} (+-{})',
+                             name.decode('ascii', 'replace'), count, error)
+
+    def lookup(self, raw, addr, now):
+        """ Поток приема: ответ из кэша ответов, иначе собранный из кэша
+            записей, иначе None - запрос уйдет обработчикам """
+        self.log.client(addr[0])
+        try:
+            request = parse_message(raw, records=False)
+            edns = edns_mode(raw, request)
+        except DNSError as e:
+            self.log.sample('Invalid DNS request from {}: {}', addr[0], e)
+            return b''
+        if request.is_response:
+            # ответ на ответ - тоже ответ: два сервера перебрасывались
+            # бы пакетами бесконечно
+            return b''
+        if request.qdcount != 1:
+            return error_response(raw, request, RCODE_FORMERR)
+        question = request.questions[0]
+        key = question.key()
+        self.stats.seen(key[0])
+        with self.lock:
+            response = self.cache.get(
+                key + (edns,), request.id, now,
+                raw[HEADER.size:request.questions_end])
+            # в кэше записей нет RRSIG: клиенту с DO - только от
+            # форвардера или из кэша ответов
+            answers = self.records.resolve(*key, now=now) \
+                if response is None and not edns & EDNS_DO else None
+        if response is not None:
+            self.stats.cached(response, question.qtype, now)
+            if self.cache.prefetch:
+                self.refresh_hot(now)
+            return response
+        if answers:
+            response = build_response(request.id, response_flags(request),
+                                      question, answers, self.builder)
+            self.stats.count(RECORDS)
+            self.stats.latency(CACHE_PATH, question.qtype, now)
+            return response
+        self.stats.count(MISS)
+        return None
+
+    def handle(self, raw, addr, req_time, upstream):
+        """ Обработчик: промах (upstream None) - форвардеру, готовый
+            ответ форвардера - в кэши и клиенту """
+        # заголовок и вопрос уже проверены в lookup
+        request = parse_message(raw, records=False)
+        if upstream is not None:
+            response = self.complete(raw, request, upstream)
+            if addr is not None:
+                self.stats.latency(UPSTREAM_PATH,
+                                   request.questions[0].qtype, req_time)
+            return response
+        try:
+            looped = self.guard.is_loop(raw, parse_message(raw))
+        except DNSError:
+            return error_response(raw, request, RCODE_FORMERR)
+        if looped:
+            # запрос уже проходил через нас: дальше не пересылаем
+            self.log.sample('Forwarding loop for {!r} from {}',
+                            request.questions[0].name, addr[0])
+            return error_response(raw, request, RCODE_SERVFAIL)
+        self.forward(raw, addr, req_time)
+        return None
 
-    def prepare_response(self):
-        pass
-
-    def parse_request(self):
-        pass
-
-
-def encode_dns_message(url):
-    # Flags
-    # QR = 0      # Query: 0, Response: 1     1bit
-    # OPCODE = 0  # Standard query            4bit
-    # AA = 0      # ?                         1bit
-    # TC = 0      # Message is truncated?     1bit
-    # RD = 1      # Recursion?                1bit
-    # RA = 0      # ?                         1bit
-    # Z = 0       # ?                         3bit
-    # RCODE = 0   # ?                         4bit
-    randint = random.randint(0, 65535)
-    packet = struct.pack(">H", randint)  # Query Ids # Query: 0, Response: 1
-    packet += struct.pack(">H", 0x0100)  # Flags
-    packet += struct.pack(">H", 1)  # QDCOUNT  Number of questions         4bit
-    packet += struct.pack(">H", 0)  # ANCOUNT  Number of answers           4bit
-    packet += struct.pack(">H", 0)  # NSCOUNT  Number of authority records 4bit
-    packet += struct.pack(">H", 0)  # ARCOUNT  Number of additional records4bit
-    split_url = url.split(".")
-    for part in split_url:
-        packet += struct.pack("B", len(part))
-        for s in part:
-            packet += struct.pack('c', s.encode())
-    packet += struct.pack("B", 0)   # Terminating bit for QNAME
-    packet += struct.pack(">H", 1)  # QTYPE Query Type
-    packet += struct.pack(">H", 1)  # QCLASS Query Class
-    return packet
-
-
-def decode_labels(message, offset):
-    labels = []
-
-    while True:
-        length, = struct.unpack_from("!B", message, offset)
-
-        if (length & 0xC0) == 0xC0:
-            pointer, = struct.unpack_from("!H", message, offset)
-            offset += 2
-
-            return labels + decode_labels(message, pointer & 0x3FFF), offset
-
-        if (length & 0xC0) != 0x00:
-            # raise StandardError("unknown label encoding")
-            print("unknown label encoding")
-            return
-
-        offset += 1
-        if length == 0:
-            return labels, offset
-        labels.append(*struct.unpack_from("!%ds" % length, message, offset))
-        offset += length
-
-
-def decode_question_section(message, offset, qdcount):
-    questions = []
-    for _ in range(qdcount):
-        qname, offset = decode_labels(message, offset)
-        qtype, qclass = struct.unpack_from("!2H", message, offset)
-        offset += struct.calcsize("!2H")
-        question = {"domain_name": qname,
-                    "query_type": qtype,
-                    "query_class": qclass}
-        questions.append(question)
-
-    return questions, offset
-
-
-def parse_flags(flags):
-    res = {}
-    res['qr'] = (flags & 0x8000) != 0
-    res['opcode'] = (flags & 0x7800) >> 11
-    res['aa'] = (flags & 0x0400) != 0
-    res['tc'] = (flags & 0x200) != 0
-    res['rd'] = (flags & 0x100) != 0
-    res['ra'] = (flags & 0x80) != 0
-    res['z'] = (flags & 0x70) >> 4
-    res['rcode'] = flags & 0xF
-    return res
-
-
-def decode_dns_message(message):
-    id, raw_flags, qdcount, ancount, ns, ar = struct.unpack("!6H", message)
-    flags = parse_flags(raw_flags)
-    offset = struct.calcsize("!6H")
-    questions, offset = decode_question_section(message, offset, qdcount)
-
-    result = {"id": id,
-              "is_response": flags['qr'],
-              "opcode": flags['opcode'],
-              "is_authoritative": flags['aa'],
-              "is_truncated": flags['tc'],
-              "recursion_desired": flags['rd'],
-              "recursion_available": flags['ra'],
-              "reserved": flags['z'],
-              "response_code": flags['rcode'],
-              "question_count": qdcount,
-              "answer_count": ancount,
-              "authority_count": ns,
-              "additional_count": ar,
-              "questions": questions}
-
-    return result
+    def forward(self, raw, addr, req_time):
+        """ Не ждем форвардера: готовый ответ (или ошибка) вернется
+            в очередь задач """
+        future = self.forwarder.submit(raw)
+        future.add_done_callback(
+            lambda done: self.core.put((raw, addr, req_time, done)))
+
+    def refresh_hot(self, now):
+        """ Популярные записи, прожившие долю TTL, запрашиваем заново
+            в фоне; ответ обновит кэш через complete """
+        with self.lock:
+            hot = self.cache.prefetch
+            self.cache.prefetch = []
+        for name, qtype, qclass, edns in hot:
+            # с тем же EDNS0, что у запроса, ответ на который обновляем
+            query = encode_query(
+                name, qtype, qclass,
+                payload=EDNS_PAYLOAD if edns & EDNS_OPT else 0,
+                edns_flags=EDNS_FLAG_DO if edns & EDNS_DO else 0)
+            self.stats.count(PREFETCHED)
+            self.forward(query, None, now)
+
+    def complete(self, raw, request, upstream):
+        """ Ответ форвардера в кэши и клиенту. Никто не ответил -
+            устаревшая запись (RFC 8767), если есть, иначе SERVFAIL """
+        try:
+            response = upstream.result()
+        except Exception as e:
+            self.log.sample('forward error: {}', e)
+            with self.lock:
+                stale = self.cache.get_stale(
+                    cache_key(raw, request), request.id,
+                    question=raw[HEADER.size:request.questions_end])
+            if stale is not None:
+                self.stats.count(STALE)
+                return stale
+            return error_response(raw, request, RCODE_SERVFAIL)
+        try:
+            message = parse_message(response)
+        except DNSError as e:
+            self.log.sample('Invalid DNS response for {!r}: {}',
+                            request.questions[0].name, e)
+            return response
+        with self.lock:
+            self.cache.put(cache_key(raw, request), response, message)
+            self.records.add_message(message)
+        return response
+
+
+def cache_key(raw, request):
+    """ Ключ кэша ответов: вопрос и режим EDNS0 запроса """
+    return request.questions[0].key() + (edns_mode(raw, request),)
+
+
+def parse_address(address, port=53):
+    """ 'host[:port]' -> (host, port) """
+    host, _, custom_port = address.partition(':')
+    return host, int(custom_port or port)
 
 
 if __name__ == "__main__":
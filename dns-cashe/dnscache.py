@@ -0,0 +1,304 @@
+""" Кэш DNS-ответов в памяти с учетом TTL.
+
+Ключ - вопрос (qname, qtype, qclass), qname в нижнем регистре, и режим
+EDNS0 запроса (dnswire.edns_mode): клиенту без EDNS0 нельзя отдать
+ответ с OPT, а клиенту без DO - с RRSIG.
+Запись хранит ответ форвардера целиком, абсолютное время устаревания и
+смещения полей TTL всех записей ответа. При выдаче из кэша TTL
+переписываются на оставшееся время жизни: если 10 секунд назад получили
+ttl=700, клиент увидит 690.
+
+    * поиск - один доступ к dict, без SQL и разбора пакета;
+    * LRU (OrderedDict) с ограничением по числу записей и по байтам;
+    * устаревшие записи выталкиваются по куче сроков (heapq), ленивое
+      удаление: в куче могут остаться сроки уже замененных записей;
+    * prefetch: у записи счетчик попаданий (насыщающийся, до MAX_HITS,
+      обнуляется вместе с записью). Если запись популярна
+      (prefetch_hits попаданий) и прожила долю prefetch своего TTL,
+      её ключ попадает в список self.prefetch - сервер обновит её
+      у форвардера заранее, и клиенты не увидят промаха на истечении;
+    * serve-stale (RFC 8767): устаревшая запись хранится еще max_stale
+      секунд; если форвардер недоступен, get_stale отдает её с TTL
+      stale_ttl;
+    * снимок на диске (snapshot.Snapshot): при промахе запись ищется
+      в снимке прошлого запуска и переносится в память;
+    * отрицательные ответы (RFC 2308): NXDOMAIN и NODATA (NOERROR без
+      ответов) хранятся так же, как обычные, - ответ целиком, в том же
+      LRU и в том же бюджете байт. Время жизни - меньшее из TTL записи
+      SOA в секции NS и её поля MINIMUM, не больше max_negative; TTL
+      записей ответа при выдаче не превышают его. Без SOA ответ не
+      кэшируется.
+
+DNSCache рассчитан на один поток. Для серверов, где кэш трогают
+несколько потоков (ThreadingUDPServer), есть ShardedCache: ключи
+распределены по hash(key) между shards независимыми DNSCache, у каждого
+своя блокировка. Потоки, попавшие в разные части, друг друга не ждут,
+а LRU и куча сроков у части в shards раз меньше.
+"""
+
+import collections
+import heapq
+import struct
+import threading
+import time
+
+TTL = struct.Struct('!I')
+HEADER_SIZE = 12
+TYPE_SOA = 6
+TYPE_OPT = 41
+RCODE_NXDOMAIN = 3
+ENTRY_OVERHEAD = 200  # примерный расход памяти на запись кроме ответа
+MAX_HITS = 255
+PREFETCH = 0.9
+PREFETCH_HITS = 4
+MAX_STALE = 86400  # RFC 8767: от 1 до 3 суток
+STALE_TTL = 30  # RFC 8767, 4
+MAX_NEGATIVE = 10800  # RFC 2308, 5: 1-3 часа
+SHARDS = 16
+
+
+def ttl_offsets(message):
+    """ Смещения полей TTL и их значения для всех записей разобранного
+        ответа (common.dnswire.Message), кроме псевдозаписи OPT - у неё
+        в поле TTL флаги EDNS """
+    return [(record.ttl_offset, record.ttl) for record in message.records()
+            if record.rtype != TYPE_OPT]
+
+
+def negative_ttl(message):
+    """ Время жизни отрицательного ответа (RFC 2308, 5): меньшее из TTL
+        SOA в секции NS и поля MINIMUM; None - если SOA нет """
+    for record in message.authorities:
+        if record.rtype == TYPE_SOA and len(record.rdata) >= TTL.size:
+            minimum, = TTL.unpack_from(record.rdata,
+                                       len(record.rdata) - TTL.size)
+            return min(record.ttl, minimum)
+    return None
+
+
+class Entry:
+    __slots__ = ('expires', 'stored', 'response', 'ttls', 'refresh', 'hits',
+                 'prefetching')
+
+    def __init__(self, expires, stored, response, ttls, refresh) -> None:
+        self.expires = expires
+        self.stored = stored
+        self.response = response
+        self.ttls = ttls
+        self.refresh = refresh  # с этого момента популярную запись обновить
+        self.hits = 0
+        self.prefetching = False
+
+
+class DNSCache:
+    def __init__(self, max_entries=1 << 20, max_bytes=256 << 20,
+                 prefetch=PREFETCH, prefetch_hits=PREFETCH_HITS,
+                 max_stale=MAX_STALE, stale_ttl=STALE_TTL,
+                 max_negative=MAX_NEGATIVE) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.prefetch_fraction = prefetch  # 0 - не обновлять заранее
+        self.prefetch_hits = prefetch_hits
+        self.max_stale = max_stale  # 0 - не отдавать устаревшее
+        self.stale_ttl = stale_ttl
+        self.max_negative = max_negative  # 0 - не кэшировать отказы
+        self.entries = collections.OrderedDict()
+        self.expiry = []  # куча (expires + max_stale, key)
+        self.size = 0
+        self.prefetch = []  # ключи, которые пора обновить у форвардера
+        self.snapshot = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def attach(self, snapshot, now=None):
+        """ Подключаем снимок прошлого запуска: записи из него читаются
+            лениво, при первом промахе по ключу """
+        now = time.time() if now is None else now
+        if snapshot is not None and snapshot.deadline + self.max_stale > now:
+            self.snapshot = snapshot
+
+    def get(self, key, txid, now=None, question=None):
+        """ Ответ из кэша с идентификатором txid, секцией вопросов
+            question из запроса и пересчитанными TTL, None - если записи
+            нет или она устарела """
+        now = time.time() if now is None else now
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._restore(key, now)
+            if entry is None:
+                return None
+        if entry.expires <= now:
+            # устаревшая запись лежит до expires + max_stale для get_stale
+            if entry.expires + self.max_stale <= now:
+                self._remove(key)
+            return None
+        self.entries.move_to_end(key)
+        if entry.hits < MAX_HITS:
+            entry.hits += 1
+        if entry.refresh <= now and entry.hits >= self.prefetch_hits and \
+                not entry.prefetching:
+            entry.prefetching = True
+            self.prefetch.append(key)
+        response = self._copy(entry, txid, question)
+        elapsed = int(now - entry.stored)
+        for offset, ttl in entry.ttls:
+            TTL.pack_into(response, offset, max(0, ttl - elapsed))
+        return response
+
+    def get_stale(self, key, txid, now=None, question=None):
+        """ Устаревший ответ с TTL stale_ttl, когда форвардер не ответил
+            (RFC 8767), None - если записи нет или она старше max_stale """
+        now = time.time() if now is None else now
+        entry = self.entries.get(key) or self._restore(key, now)
+        if entry is None or entry.expires + self.max_stale <= now:
+            return None
+        response = self._copy(entry, txid, question)
+        for offset, ttl in entry.ttls:
+            TTL.pack_into(response, offset, min(ttl, self.stale_ttl))
+        return response
+
+    def _copy(self, entry, txid, question):
+        response = bytearray(entry.response)
+        struct.pack_into('!H', response, 0, txid)
+        # ответ сохранен с написанием имени первого спросившего; клиенты
+        # с DNS 0x20 ждут свое - вопрос той же длины, отличается регистр
+        end = HEADER_SIZE + len(question or b'')
+        if question and bytes(response[HEADER_SIZE:end]).lower() == \
+                bytes(question).lower():
+            response[HEADER_SIZE:end] = question
+        return response
+
+    def put(self, key, response, message, now=None):
+        """ Сохраняем ответ форвардера (message - он же, разобранный);
+            обрезанные (TC), с ошибкой сервера и отрицательные без SOA
+            не кэшируются. Возвращает время жизни """
+        if message.flags & 0x0200:  # TC
+            return 0
+        rcode = message.flags & 0x000F
+        ttls = ttl_offsets(message)
+        if rcode == RCODE_NXDOMAIN or (rcode == 0 and not message.answers):
+            lifetime = negative_ttl(message)
+            if lifetime is None:
+                return 0
+            lifetime = min(lifetime, self.max_negative)
+            ttls = [(offset, min(ttl, lifetime)) for offset, ttl in ttls]
+        elif rcode or not ttls:
+            return 0
+        else:
+            lifetime = min(ttl for _, ttl in ttls)
+        if lifetime <= 0:
+            return 0
+        now = time.time() if now is None else now
+        if key in self.entries:
+            self._remove(key)
+        refresh = now + lifetime * self.prefetch_fraction \
+            if self.prefetch_fraction else float('inf')
+        entry = Entry(now + lifetime, now, bytes(response), ttls, refresh)
+        self._insert(key, entry)
+        self.purge(now)
+        return lifetime
+
+    def items(self, now=None):
+        """ Живые записи (включая устаревшие в пределах max_stale) для
+            снимка: из памяти и еще не прочитанные из прошлого снимка.
+            Можно вызывать из другого потока: копия словаря снимается
+            за одну операцию под GIL, записи после вставки не меняются
+            (кроме счетчиков prefetch) """
+        now = time.time() if now is None else now
+        live = [(key, entry) for key, entry in list(self.entries.items())
+                if entry.expires + self.max_stale > now]
+        snapshot = self.snapshot
+        if snapshot is not None:
+            seen = {key for key, _ in live}
+            live.extend((key, entry) for key, entry in snapshot
+                        if key not in seen and
+                        entry.expires + self.max_stale > now)
+        return live
+
+    def _restore(self, key, now):
+        """ Запись из снимка в память, None - если её там нет """
+        if self.snapshot is None:
+            return None
+        if self.snapshot.deadline + self.max_stale <= now:
+            self.snapshot = None  # все записи снимка уже не нужны
+            return None
+        entry = self.snapshot.get(key)
+        if entry is None or entry.expires + self.max_stale <= now:
+            return None
+        if self.prefetch_fraction:
+            entry.refresh = entry.stored + \
+                (entry.expires - entry.stored) * self.prefetch_fraction
+        self._insert(key, entry)
+        self.purge(now)
+        return entry
+
+    def _insert(self, key, entry):
+        self.entries[key] = entry
+        self.size += len(entry.response) + ENTRY_OVERHEAD
+        heapq.heappush(self.expiry, (entry.expires + self.max_stale, key))
+
+    def purge(self, now=None):
+        """ Удаляем записи старше max_stale и лишнее по LRU """
+        now = time.time() if now is None else now
+        expiry = self.expiry
+        while expiry and expiry[0][0] <= now:
+            deadline, key = heapq.heappop(expiry)
+            entry = self.entries.get(key)
+            if entry is not None and \
+                    entry.expires + self.max_stale == deadline:
+                self._remove(key)
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.size > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+        # куча не должна расти из-за сроков давно вытесненных записей
+        if len(expiry) > 2 * len(self.entries) + 1024:
+            self.expiry = [(e.expires + self.max_stale, k)
+                           for k, e in self.entries.items()]
+            heapq.heapify(self.expiry)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= len(entry.response) + ENTRY_OVERHEAD
+
+
+class ShardedCache:
+    """ Потокобезопасный кэш: shards частей DNSCache со своими
+        блокировками. Лимиты max_entries и max_bytes делятся поровну
+        между частями, остальные параметры - как у DNSCache """
+    def __init__(self, shards=SHARDS, max_entries=1 << 20,
+                 max_bytes=256 << 20, **options) -> None:
+        if shards < 1 or shards & (shards - 1):
+            raise ValueError('shards must be a power of two')
+        self.mask = shards - 1
+        self.shards = [DNSCache(max(1, max_entries // shards),
+                                max(1, max_bytes // shards), **options)
+                       for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def size(self):
+        return sum(shard.size for shard in self.shards)
+
+    def get(self, key, txid, now=None, question=None):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return self.shards[index].get(key, txid, now, question)
+
+    def get_stale(self, key, txid, now=None, question=None):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return self.shards[index].get_stale(key, txid, now, question)
+
+    def put(self, key, response, message, now=None):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return self.shards[index].put(key, response, message, now)
+
+    def purge(self, now=None):
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                shard.purge(now)
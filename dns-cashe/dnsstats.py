@@ -0,0 +1,193 @@
+""" Статистика DNS-серверов (dns-evil.py, raw_.py) для подбора размера
+кэша и проверки, окупается ли работа с TTL.
+
+    * счетчики исходов запросов: попадание, отрицательное попадание
+      (NXDOMAIN/NODATA из кэша), ответ, собранный из кэша записей,
+      промах, устаревший ответ (serve-stale);
+    * счетчики форвардера (отправлено, склеено, повторено по TCP,
+      обновлено заранее), ядра сервера и размер кэша - переносятся в
+      ячейки перед каждой выдачей (refresh);
+    * гистограммы задержки от приема до ответа отдельно для ответов из
+      кэша и от форвардера, по типам запросов;
+    * самые частые имена - space-saving (SpaceSaving) на TOP_CAPACITY
+      имен, память не растет с числом разных имен.
+
+Все это - ячейки common.metrics: /metrics в формате Prometheus, горячие
+имена - на /top того же HTTP-сервера. Счетчики, как и в SNTPserver,
+пишутся без блокировок: для статистики редкие гонки не страшны.
+"""
+
+import heapq
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.metrics import Metrics, serve_metrics  # noqa: E402
+
+TOP_CAPACITY = 1024
+TOP = 20
+RCODE_NXDOMAIN = 3
+
+QTYPES = ((1, 'A'), (2, 'NS'), (5, 'CNAME'), (6, 'SOA'), (12, 'PTR'),
+          (15, 'MX'), (16, 'TXT'), (28, 'AAAA'), (33, 'SRV'), (65, 'HTTPS'),
+          (255, 'ANY'), (None, 'other'))
+QTYPE_INDEX = {qtype: i for i, (qtype, _) in enumerate(QTYPES)}
+OTHER = len(QTYPES) - 1
+PATHS = ('cache', 'upstream')
+CACHE_PATH, UPSTREAM_PATH = range(len(PATHS))
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                  0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+METRICS = Metrics()
+OUTCOMES = ('hit', 'negative_hit', 'records', 'miss', 'stale')
+QUERIES = METRICS.counter(
+    'dns_queries_total', 'Queries by outcome',
+    ['result="{}"'.format(outcome) for outcome in OUTCOMES])
+HIT, NEGATIVE_HIT, RECORDS, MISS, STALE = \
+    range(QUERIES, QUERIES + len(OUTCOMES))
+UPSTREAM_KINDS = ('forwarded', 'coalesced', 'tcp_retry', 'prefetched')
+UPSTREAM = METRICS.counter(
+    'dns_upstream_queries_total', 'Forwarder queries by kind',
+    ['kind="{}"'.format(kind) for kind in UPSTREAM_KINDS])
+FORWARDED, COALESCED, TCP_RETRIES, PREFETCHED = \
+    range(UPSTREAM, UPSTREAM + len(UPSTREAM_KINDS))
+SERVER_KINDS = ('inline', 'dispatched', 'rejected', 'truncated')
+SERVER = METRICS.counter(
+    'dns_server_queries_total', 'Server core: answered on receive, '
+    'queued to workers, rejected on full queue, truncated UDP answers',
+    ['kind="{}"'.format(kind) for kind in SERVER_KINDS])
+INLINE, DISPATCHED, REJECTED, TRUNCATED = \
+    range(SERVER, SERVER + len(SERVER_KINDS))
+CACHE_ENTRIES = METRICS.gauge('dns_cache_entries', 'Cached answers')
+CACHE_BYTES = METRICS.gauge('dns_cache_bytes', 'Approximate cache size')
+LATENCY = METRICS.histogram(
+    'dns_response_latency_seconds', 'Receive-to-answer latency',
+    LATENCY_BOUNDS, labels=['path="{}",qtype="{}"'.format(path, name)
+                            for path in PATHS for _, name in QTYPES])
+LATENCY_STRIDE = len(LATENCY_BOUNDS) + 3
+
+
+def is_negative(response):
+    """ NXDOMAIN или NODATA: RCODE 3 или пустая секция ответов """
+    return response[3] & 0x0F == RCODE_NXDOMAIN or \
+        not (response[6] or response[7])
+
+
+class SpaceSaving:
+    """ Самые частые ключи потока (Metwally и др., space-saving):
+        отслеживается не больше capacity ключей. Новый ключ при
+        заполнении вытесняет ключ с наименьшим счетчиком и наследует
+        его счетчик как погрешность: ключ, встреченный больше
+        total / capacity раз, гарантированно в списке, а счетчик
+        завышен не больше чем на погрешность """
+    def __init__(self, capacity=TOP_CAPACITY) -> None:
+        self.capacity = capacity
+        self.counts = {}  # ключ -> [счетчик, погрешность]
+        # (счетчик на момент записи, ключ) - по записи на ключ; счетчик
+        # в куче обновляется лениво, когда запись доходит до вершины
+        self.heap = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key):
+        self.total += 1
+        counter = self.counts.get(key)
+        if counter is not None:
+            counter[0] += 1
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[key] = [1, 0]
+            heapq.heappush(self.heap, (1, key))
+            return
+        while True:
+            count, victim = self.heap[0]
+            current = self.counts[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(self.heap, (current, victim))
+        del self.counts[victim]
+        self.counts[key] = [count + 1, count]
+        heapq.heapreplace(self.heap, (count + 1, key))
+
+    def top(self, n):
+        """ [(счетчик, погрешность, ключ)] по убыванию счетчика """
+        return heapq.nlargest(n, ((count, error, key) for key, (count, error)
+                                  in self.counts.items()))
+
+
+class QueryStats:
+    def __init__(self, top_capacity=TOP_CAPACITY, top=TOP) -> None:
+        self.cells = METRICS.allocate()
+        self.hot = SpaceSaving(top_capacity)
+        self.top = top
+        self.lock = threading.Lock()  # hot трогают потоки приема
+
+    def seen(self, name):
+        with self.lock:
+            self.hot.add(name)
+
+    def count(self, offset):
+        self.cells[offset] += 1
+
+    def latency(self, path, qtype, started, now=None):
+        now = time.time() if now is None else now
+        index = path * len(QTYPES) + QTYPE_INDEX.get(qtype, OTHER)
+        METRICS.observe(self.cells, LATENCY + index * LATENCY_STRIDE,
+                        max(0.0, now - started))
+
+    def cached(self, response, qtype, started):
+        """ Ответ из кэша ответов: попадание или отрицательное """
+        self.count(NEGATIVE_HIT if is_negative(response) else HIT)
+        self.latency(CACHE_PATH, qtype, started)
+
+    def update(self, forwarder=None, core=None, cache=None):
+        """ Переносим в ячейки счетчики, которые ведут другие объекты """
+        cells = self.cells
+        if forwarder is not None:
+            cells[FORWARDED] = forwarder.forwarded
+            cells[COALESCED] = forwarder.coalesced
+            cells[TCP_RETRIES] = forwarder.truncated
+        if core is not None:
+            cells[INLINE] = core.inline
+            cells[DISPATCHED] = core.dispatched
+            cells[REJECTED] = core.rejected
+            cells[TRUNCATED] = core.truncated
+        if cache is not None:
+            cells[CACHE_ENTRIES] = len(cache)
+            cells[CACHE_BYTES] = cache.size
+
+    def summary(self):
+        """ Строка для лога: исходы запросов и доля попаданий """
+        cells = self.cells
+        answered = cells[HIT] + cells[NEGATIVE_HIT] + cells[RECORDS]
+        total = answered + cells[MISS]
+        return 'hits {} (negative {}, records {}), misses {}, hit ratio ' \
+            '{:.1%}, stale served {}, prefetched {}'.format(
+                cells[HIT], cells[NEGATIVE_HIT], cells[RECORDS],
+                cells[MISS], answered / total if total else 0.0,
+                cells[STALE], cells[PREFETCHED])
+
+    def hot_names(self, n=None):
+        with self.lock:
+            return self.hot.top(self.top if n is None else n)
+
+    def render_top(self):
+        """ Страница /top: счетчик, погрешность и имя, по строке """
+        with self.lock:
+            total = self.hot.total
+            top = self.hot.top(self.top)
+        lines = ['# queries {} tracked {}'.format(total, len(self.hot))]
+        lines.extend('{} {} {}'.format(count, error,
+                                       name.decode('ascii', 'replace'))
+                     for count, error, name in top)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host, port, refresh=None):
+        """ /metrics и /top в фоновом потоке """
+        return serve_metrics(METRICS, [self.cells], host, port,
+                             refresh=refresh, pages={'/top': self.render_top})
@@ -0,0 +1,522 @@
+""" Асинхронный клиент форвардеров.
+
+Цикл событий asyncio крутится в отдельном потоке и держит пул
+долгоживущих UDP-сокетов (по pool_size на каждый вышестоящий сервер).
+Сокеты не создаются на каждый запрос, в полете одновременно могут быть
+тысячи запросов.
+
+    * перед отправкой ID запроса заменяется на свободный ID сокета,
+      в ответе возвращается ID клиента;
+    * сокет пула, отправивший socket_queries запросов или проживший
+      socket_lifetime секунд, заменяется новым: исходный порт тоже
+      меняется, и подделать ответ, угадав ID и порт, не проще, чем
+      при отдельном сокете на запрос (RFC 5452, 10). Старый сокет
+      закрывается через timeout - опоздавшие ответы еще дойдут;
+    * ответ сопоставляется с ожидающим запросом по ID и по секции
+      вопросов (чужой или опоздавший ответ отбрасывается);
+    * на каждую попытку - своя future с таймаутом; не дождались или
+      получили ICMP unreachable - повтор у следующего сервера;
+    * submit() потокобезопасен и сразу возвращает
+      concurrent.futures.Future: поток, который отвечает клиентам,
+      никогда не ждет форвардера;
+    * одинаковые запросы в полете склеиваются (singleflight): первый
+      промах по (qname, qtype, qclass, флаги, режим EDNS0) уходит
+      форвардеру, следующие ждут его ответа. Когда у популярного имени
+      истекает TTL, к форвардеру уходит один запрос, а не по одному на
+      клиента;
+    * по каждому форвардеру считаются сглаженные RTT и его разброс
+      (как RTO в TCP, RFC 6298) и доля отказов. Запрос уходит самому
+      быстрому здоровому серверу; если тот не ответил за свое обычное
+      время (srtt + 4 * rttvar), тот же запрос дублируется следующему
+      (hedging), побеждает первый ответ;
+    * circuit breaker: после BREAKER_FAILURES отказов подряд сервер
+      выключается на cooldown, затем получает один пробный запрос;
+      снова отказ - cooldown удваивается. Пока выключены все серверы,
+      запрос сразу завершается ошибкой: сервер ответит устаревшей
+      записью или SERVFAIL, не дожидаясь таймаутов;
+    * обрезанный ответ (TC=1) переспрашивается у того же сервера по
+      TCP (RFC 7766): к каждому форвардеру одно постоянное соединение,
+      запросы идут подряд, не дожидаясь ответов (pipelining), ответы
+      сопоставляются по ID. Соединение открывается при первой
+      надобности и закрывается после STREAM_IDLE секунд без запросов.
+"""
+
+import asyncio
+import itertools
+import time
+import os
+import random
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.dnswire import (FLAG_TC, FRAME_SIZE,  # noqa: E402
+                            HEADER, edns_mode, parse_message, remove_opt,
+                            reply_to)
+
+POOL_SIZE = 4
+ATTEMPT_TIMEOUT = 1
+ATTEMPTS = 3
+ID_TRIES = 8
+# флаги, от которых зависит ответ: RD, AD, CD
+COALESCE_FLAGS = 0x0130
+
+RTT_ALPHA = 1 / 8  # RFC 6298
+RTT_BETA = 1 / 4
+FAILURE_ALPHA = 1 / 16
+INITIAL_RTT = 0.1
+MIN_HEDGE = 0.01
+FAILURE_PENALTY = 4  # на сколько srtt ухудшает оценку доля отказов 1.0
+BREAKER_FAILURES = 5
+BREAKER_COOLDOWN = 5
+MAX_COOLDOWN = 120
+STREAM_IDLE = 10
+SOCKET_QUERIES = 1000  # запросов через один сокет пула до замены
+SOCKET_LIFETIME = 60  # секунд жизни сокета пула до замены
+
+CLOSED = 'closed'  # сервер работает
+OPEN = 'open'  # выключен до open_until
+HALF_OPEN = 'half-open'  # пробный запрос, следующая проба после open_until
+
+
+class PendingQueries:
+    """ Запросы, ждущие ответа в одном сокете или соединении """
+    def __init__(self) -> None:
+        self.pending = {}  # ID на проводе -> (секция вопросов, future)
+
+    def answer(self, data):
+        if len(data) < HEADER.size:
+            return
+        waiter = self.pending.get(data[0] << 8 | data[1])
+        if waiter is None:
+            return
+        question, future = waiter
+        if data[HEADER.size:HEADER.size + len(question)] != question:
+            return
+        del self.pending[data[0] << 8 | data[1]]
+        if not future.done():
+            future.set_result(data)
+
+    def fail(self, exc):
+        pending, self.pending = self.pending, {}
+        for _, future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    def reserve(self, question, future):
+        """ Свободный ID на проводе или None, если не нашли за ID_TRIES """
+        for _ in range(ID_TRIES):
+            txid = random.getrandbits(16)
+            if txid not in self.pending:
+                self.pending[txid] = (question, future)
+                return txid
+        return None
+
+    def release(self, txid, future):
+        waiter = self.pending.get(txid)
+        if waiter is not None and waiter[1] is future:
+            del self.pending[txid]
+
+
+class UpstreamProtocol(PendingQueries, asyncio.DatagramProtocol):
+    """ Один подключенный UDP-сокет к форвардеру и его ожидающие запросы """
+    def __init__(self) -> None:
+        super().__init__()
+        self.transport = None
+        self.opened = time.monotonic()
+        self.used = 0  # запросов отправлено
+        self.retiring = False  # замена уже открывается
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.answer(data)
+
+    def error_received(self, exc):
+        # ICMP unreachable: сервер недоступен, ждать таймаута незачем
+        self.fail(exc)
+
+    def connection_lost(self, exc):
+        self.fail(exc or ConnectionError('upstream socket closed'))
+
+
+class StreamConnection(PendingQueries):
+    """ Постоянное TCP-соединение к форвардеру (RFC 7766, 6.2.1):
+        запросы пишутся друг за другом, ответы читает одна задача и
+        раздает по ID в любом порядке. Оборвалось - ждущие запросы
+        получают ошибку, следующий запрос откроет новое соединение """
+    def __init__(self, loop, address, idle=STREAM_IDLE) -> None:
+        super().__init__()
+        self.loop = loop
+        self.address = address
+        self.idle = idle
+        self.writer = None
+        self.connecting = None
+        self.connections = 0  # сколько раз открывали
+
+    async def exchange(self, message, future):
+        """ Отправляет сообщение (ID уже в pending) и ждет ответа """
+        writer = self.writer
+        if writer is None:
+            if self.connecting is None:
+                self.connecting = self.loop.create_task(self.connect())
+            # shield: таймаут одного запроса не обрывает подключение
+            writer = await asyncio.shield(self.connecting)
+        if writer.is_closing():
+            # соединение успело оборваться, пока подключались
+            raise ConnectionError('upstream closed TCP connection')
+        writer.write(len(message).to_bytes(FRAME_SIZE, 'big') + message)
+        await writer.drain()
+        return await future
+
+    async def connect(self):
+        try:
+            reader, writer = await asyncio.open_connection(*self.address)
+        finally:
+            self.connecting = None
+        self.connections += 1
+        self.writer = writer
+        self.loop.create_task(self.read(reader, writer))
+        return writer
+
+    async def read(self, reader, writer):
+        error = ConnectionError('upstream closed TCP connection')
+        try:
+            while True:
+                try:
+                    # без ожидающих запросов соединение живет self.idle
+                    header = await asyncio.wait_for(
+                        reader.readexactly(FRAME_SIZE),
+                        None if self.pending else self.idle)
+                except asyncio.TimeoutError:
+                    if self.pending:
+                        continue
+                    break
+                size = int.from_bytes(header, 'big')
+                self.answer(await reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            pass
+        except OSError as e:
+            error = e
+        finally:
+            if self.writer is writer:
+                self.writer = None
+            writer.close()
+            self.fail(error)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _consume(task):
+    if not task.cancelled():
+        task.exception()
+
+
+class Upstream:
+    """ Форвардер: его сокеты, оценки RTT и отказов, состояние
+        circuit breaker. Меняется только из цикла событий """
+    def __init__(self, address) -> None:
+        self.address = address
+        self.pool = []
+        self.turn = None
+        self.stream = None
+        self.srtt = INITIAL_RTT
+        self.rttvar = INITIAL_RTT / 2
+        self.failure_rate = 0.0
+        self.failures = 0  # отказов подряд
+        self.state = CLOSED
+        self.open_until = 0
+        self.cooldown = BREAKER_COOLDOWN
+
+    def __str__(self):
+        return '{}:{} rtt {:.1f}ms fail {:.2f} {}'.format(
+            self.address[0], self.address[1], self.srtt * 1000,
+            self.failure_rate, self.state)
+
+    def score(self):
+        """ Ожидаемая задержка с поправкой на отказы: меньше - лучше """
+        return self.srtt * (1 + FAILURE_PENALTY * self.failure_rate)
+
+    def hedge_delay(self, limit):
+        """ Сколько ждать ответа, прежде чем спросить следующего """
+        return min(max(self.srtt + 4 * self.rttvar, MIN_HEDGE), limit)
+
+    def available(self, now):
+        if self.state == CLOSED:
+            return True
+        if self.open_until <= now:
+            # один пробный запрос; если он так и не ушел (сервер оказался
+            # не первым в очереди) - следующая проба через cooldown
+            self.state = HALF_OPEN
+            self.open_until = now + self.cooldown
+            return True
+        return False
+
+    def answered(self, rtt):
+        self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+        self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.failure_rate -= FAILURE_ALPHA * self.failure_rate
+        self.failures = 0
+        self.state = CLOSED
+        self.cooldown = BREAKER_COOLDOWN
+
+    def failed(self, now):
+        self.failure_rate += FAILURE_ALPHA * (1 - self.failure_rate)
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, MAX_COOLDOWN)
+        elif self.failures < BREAKER_FAILURES or self.state == OPEN:
+            return
+        self.state = OPEN
+        self.open_until = now + self.cooldown
+
+
+class Forwarder:
+    def __init__(self, servers, pool_size=POOL_SIZE,
+                 timeout=ATTEMPT_TIMEOUT, attempts=ATTEMPTS,
+                 log=None, guard=None, socket_queries=SOCKET_QUERIES,
+                 socket_lifetime=SOCKET_LIFETIME) -> None:
+        self.upstreams = [Upstream(address) for address in servers]
+        self.pool_size = pool_size
+        self.socket_queries = socket_queries
+        self.socket_lifetime = socket_lifetime
+        self.retired = set()  # замененные сокеты до закрытия
+        self.timeout = timeout
+        self.attempts = attempts
+        self.log = log or BufferedLog()
+        self.guard = guard  # loopguard.LoopGuard: метка и учет запросов
+        self.loop = None
+        self.thread = None
+        self.inflight = {}  # ключ вопроса -> future ответа форвардера
+        self.forwarded = 0  # запросов ушло форвардерам
+        self.coalesced = 0  # запросов сэкономлено склейкой
+        self.truncated = 0  # обрезанных ответов переспрошено по TCP
+
+    def start(self):
+        """ Запускает цикл событий в фоновом потоке и открывает сокеты """
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,),
+                                       daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop = None
+
+    def submit(self, query):
+        """ Потокобезопасно: запрос клиента -> concurrent.futures.Future
+            с ответом (ID клиента уже на месте) или исключением """
+        return asyncio.run_coroutine_threadsafe(self.resolve(query),
+                                                self.loop)
+
+    def query(self, query, timeout=None):
+        """ Блокирующий вариант submit: ответ или None """
+        try:
+            return self.submit(query).result(timeout)
+        except Exception as e:
+            self.log.sample('forward error: {}', e)
+            return None
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._open())
+        finally:
+            ready.set()
+        self.loop.run_forever()
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(
+            asyncio.gather(*pending, return_exceptions=True))
+        for upstream in self.upstreams:
+            for protocol in upstream.pool:
+                protocol.transport.close()
+            upstream.stream.close()
+        for protocol in self.retired:
+            protocol.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    async def _open(self):
+        for upstream in self.upstreams:
+            for _ in range(self.pool_size):
+                try:
+                    _, protocol = await self.loop.create_datagram_endpoint(
+                        UpstreamProtocol, remote_addr=upstream.address)
+                except OSError as e:
+                    self.log.log('forwarder {}:{} error:{}',
+                                 upstream.address[0], upstream.address[1], e)
+                    break
+                upstream.pool.append(protocol)
+            upstream.turn = itertools.cycle(upstream.pool)
+            upstream.stream = StreamConnection(self.loop, upstream.address)
+        self.upstreams = [upstream for upstream in self.upstreams
+                          if upstream.pool]
+
+    def pool_socket(self, upstream):
+        """ Следующий сокет пула; отслуживший свое заменяется в фоне """
+        protocol = next(upstream.turn)
+        protocol.used += 1
+        if not protocol.retiring and (
+                protocol.used >= self.socket_queries or
+                time.monotonic() - protocol.opened >= self.socket_lifetime):
+            protocol.retiring = True
+            self.loop.create_task(self._replace(upstream, protocol))
+        return protocol
+
+    async def _replace(self, upstream, old):
+        """ Новый сокет (с новым исходным портом) на место old """
+        try:
+            _, protocol = await self.loop.create_datagram_endpoint(
+                UpstreamProtocol, remote_addr=upstream.address)
+        except OSError as e:
+            self.log.sample('forwarder {}:{} socket error: {}',
+                            upstream.address[0], upstream.address[1], e)
+            # старый сокет еще послужит; следующая попытка - позже
+            old.opened, old.used, old.retiring = time.monotonic(), 0, False
+            return
+        upstream.pool[upstream.pool.index(old)] = protocol
+        upstream.turn = itertools.cycle(upstream.pool)
+        self.retired.add(old)
+        self.loop.call_later(self.timeout, self._close, old)
+
+    def _close(self, protocol):
+        self.retired.discard(protocol)
+        protocol.transport.close()
+
+    def ranked(self):
+        """ Доступные форвардеры от лучшего к худшему; выключенные не
+            спрашиваем, кроме пробного запроса """
+        now = time.monotonic()
+        ready = [upstream for upstream in self.upstreams
+                 if upstream.available(now)]
+        if not ready:
+            raise ConnectionError('all forwarders are down')
+        return sorted(ready, key=Upstream.score)
+
+    async def resolve(self, query):
+        """ Ответ на запрос клиента с его ID и его написанием вопроса;
+            одинаковые запросы в полете ждут одного ответа форвардера """
+        request = parse_message(query, records=False)
+        if request.qdcount != 1:
+            response = await self.forward(query, request)
+            return reply_to(query, response, request.questions_end)
+        # OPT в ответе и RRSIG зависят от EDNS0 запроса: склеиваем только
+        # запросы с тем же режимом
+        key = request.questions[0].key() + (
+            request.flags & COALESCE_FLAGS, edns_mode(query, request))
+        shared = self.inflight.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            # shield: отмена одного ждущего не отменяет ответ остальным
+            response = await asyncio.shield(shared)
+            return reply_to(query, response, request.questions_end)
+        shared = self.inflight[key] = self.loop.create_future()
+        try:
+            response = await self.forward(query, request)
+        except asyncio.CancelledError:
+            shared.cancel()
+            raise
+        except Exception as e:
+            shared.set_exception(e)
+            shared.exception()  # ждущих может не быть - не ругаться в лог
+            raise
+        else:
+            shared.set_result(response)
+        finally:
+            del self.inflight[key]
+        return reply_to(query, response, request.questions_end)
+
+    async def forward(self, query, request):
+        """ С LoopGuard запрос уходит с меткой экземпляра в EDNS0; если
+            клиент EDNS0 не просил, OPT из ответа убирается """
+        if self.guard is None:
+            return await self.exchange(query, request)
+        message = parse_message(query)
+        response = await self.exchange(self.guard.mark(query, message),
+                                       request)
+        if message.opt() is None:
+            response = remove_opt(response, parse_message(response))
+        return response
+
+    async def exchange(self, query, request):
+        """ Запрос лучшему форвардеру; не ответил за свое обычное
+            время или отказал - дублируем следующему. Ответ с ID на
+            проводе от того, кто ответил первым """
+        if not self.upstreams:
+            raise ConnectionError('no forwarders available')
+        question = bytes(query[HEADER.size:request.questions_end])
+        ranked = self.ranked()
+        self.forwarded += 1
+        # по кругу, но пробный запрос у полуоткрытого сервера - один
+        plan = []
+        for attempt in range(self.attempts):
+            upstream = ranked[attempt % len(ranked)]
+            if upstream.state == CLOSED or upstream not in plan:
+                plan.append(upstream)
+        attempts = set()
+        error = None
+        for attempt, upstream in enumerate(plan):
+            task = self.loop.create_task(
+                self.attempt(upstream, query, question))
+            # проигравшие попытки не отменяем: их RTT или таймаут нужны
+            # для оценки сервера; исключения забираем, чтобы не было
+            # предупреждений о необработанных ошибках
+            task.add_done_callback(_consume)
+            attempts.add(task)
+            delay = upstream.hedge_delay(self.timeout) \
+                if attempt + 1 < len(plan) else None
+            while attempts:
+                done, attempts = await asyncio.wait(
+                    attempts, timeout=delay,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break  # пора подключать следующего
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if attempt + 1 < len(plan):
+                    break  # отказ - сразу следующий
+        raise error or TimeoutError('no answer from forwarders')
+
+    async def attempt(self, upstream, query, question, tcp=False):
+        """ Одна попытка у одного форвардера, с учетом RTT и отказов;
+            ответ с TC=1 переспрашивается у него же по TCP """
+        protocol = upstream.stream if tcp else self.pool_socket(upstream)
+        future = self.loop.create_future()
+        txid = protocol.reserve(question, future)
+        if txid is None:
+            raise TimeoutError('no free transaction IDs')
+        sent = time.monotonic()
+        if self.guard is not None:
+            self.guard.remember(txid, question, sent)
+        message = txid.to_bytes(2, 'big') + query[2:]
+        try:
+            if tcp:
+                response = await asyncio.wait_for(
+                    protocol.exchange(message, future), self.timeout)
+            else:
+                protocol.transport.sendto(message)
+                response = await asyncio.wait_for(future, self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            upstream.failed(time.monotonic())
+            raise
+        finally:
+            protocol.release(txid, future)
+        upstream.answered(time.monotonic() - sent)
+        if not tcp and response[2] << 8 & FLAG_TC:
+            self.truncated += 1
+            return await self.attempt(upstream, query, question, tcp=True)
+        return response
@@ -0,0 +1,81 @@
+""" Обнаружение зацикливания форвардинга (пункты 16-20 TODO в dns-evil.py).
+
+Петля возникает, если форвардером указан сам сервер или другой его
+экземпляр, который в свою очередь спрашивает первый. Защита двойная:
+
+    * метка в запросе: каждый экземпляр при пересылке дописывает свой
+      случайный 8-байтный ID в EDNS0-опцию LOOP_OPTION (код из
+      диапазона для локального использования, RFC 6891, 9). Запрос, в
+      цепочке которого уже есть наш ID, - петля. Цепочка длиннее
+      MAX_HOPS - тоже отказ, даже если петли не видно;
+    * недавно отправленные форвардерам пары (ID на проводе, секция
+      вопросов) - ограниченный LRU. Наш же запрос, вернувшийся к нам
+      (например, через форвардер, который EDNS-опции выбрасывает, но
+      ID сохраняет), узнается по ней.
+
+На петлю сервер сразу отвечает SERVFAIL: запрос не уходит дальше, и
+каждый клиентский промах порождает не больше одного запроса по кругу.
+"""
+
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (HEADER, read_options,  # noqa: E402
+                            set_option)
+
+LOOP_OPTION = 65001
+INSTANCE_SIZE = 8
+MAX_HOPS = 8
+RECENT_SIZE = 1 << 14
+RECENT_TTL = 10  # дольше любой попытки форвардера
+
+
+class LoopGuard:
+    def __init__(self, instance=None, size=RECENT_SIZE) -> None:
+        self.instance = instance or os.urandom(INSTANCE_SIZE)
+        self.size = size
+        # (ID на проводе, секция вопросов) -> время отправки
+        self.recent = collections.OrderedDict()
+        self.loops = 0
+
+    def chain(self, message):
+        """ Цепочка ID экземпляров, через которые прошел запрос """
+        opt = message.opt()
+        if opt is None:
+            return b''
+        for code, data in read_options(opt.rdata):
+            if code == LOOP_OPTION:
+                return data
+        return b''
+
+    def mark(self, query, message):
+        """ Запрос для форвардера: цепочка с нашим ID в конце """
+        return set_option(query, message, LOOP_OPTION,
+                          self.chain(message) + self.instance)
+
+    def remember(self, txid, question, now=None):
+        """ Вызывается при отправке запроса форвардеру (поток asyncio) """
+        now = time.monotonic() if now is None else now
+        key = (txid, question)
+        self.recent[key] = now
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.size:
+            self.recent.popitem(last=False)
+
+    def is_loop(self, raw, message, now=None):
+        """ Пришедший запрос (message - разобранный целиком) - петля? """
+        now = time.monotonic() if now is None else now
+        sent = self.recent.get((message.id,
+                                bytes(raw[HEADER.size:message.questions_end])))
+        chain = self.chain(message)
+        hops = [chain[i:i + INSTANCE_SIZE]
+                for i in range(0, len(chain), INSTANCE_SIZE)]
+        if (sent is not None and now - sent < RECENT_TTL) or \
+                self.instance in hops or len(hops) >= MAX_HOPS:
+            self.loops += 1
+            return True
+        return False
@@ -1,12 +1,18 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # https://github.com/creac/dnsAgent/blob/master/dnsAgent.py
 import sys
 import os
-import logging
 import socket
-import struct
-import SocketServer
-import sqlite3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.dnswire import (HEADER, DNSError, edns_mode,  # noqa: E402
+                            parse_message)
+from dnscache import ShardedCache  # noqa: E402
+from dnsstats import MISS, UPSTREAM_PATH, QueryStats  # noqa: E402
+from forwarder import Forwarder  # noqa: E402
+from server import ServerCore  # noqa: E402
 
 
 try:
@@ -21,80 +27,59 @@ dns = (
 )
 
 pidfile = '/var/run/dnsAgent.pid'
+WORKERS = 32  # обработчики блокируются на форвардере до его таймаута
+METRICS_PORT = 9153  # http://localhost:9153/metrics и /top, 0 - выключено
 
-logging.basicConfig(
-        level=logging.DEBUG,
-        filename='/tmp/dnsAgent.log',
-        filemode='a',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        format='%(asctime)s %(levelname)-8s %(message)s',
-)
+log = BufferedLog(stream=open('/tmp/dnsAgent.log', 'a'), stamp=True)
 
 
-class cache(object):
-    def __init__(self, filename=':memory:'):
-        self.db = sqlite3.connect(filename, isolation_level=None)
-        self.db.text_factory = str
-        cursor = self.db.cursor()
-        cursor.execute('CREATE TABLE IF NOT EXISTS T_CACHE \
-        (K BLOB PRIMARY KEY,V BLOB)')
-        cursor.execute('PRAGMA journal_mode = off')
-        cursor.close()
+class DNSServer:
+    """ Обработчики для server.ServerCore: поток приема отвечает из
+        кэша, пул потоков ждет форвардера на промахах """
+    # общий для всех потоков сервера: у каждой части своя блокировка
+    dns_cache = ShardedCache(prefetch=0, max_stale=0)
+    forwarder = Forwarder(dns, log=log)  # запускается после fork
+    stats = QueryStats()
+    core = None
 
-    def get(self, K):
-        cursor = self.db.cursor()
+    def lookup(self, data, addr, now):
         try:
-            cursor.execute('SELECT V FROM T_CACHE WHERE K = ?', (K,))
-            return cursor.fetchall()[0][0]
-        except IndexError:
-            pass
-        finally:
-            cursor.close()
-
-    def put(self, K, V):
-        cursor = self.db.cursor()
+            request = parse_message(data, records=False)
+            edns = edns_mode(data, request)
+        except DNSError as e:
+            log.sample('WARNING  invalid request: {}', e)
+            return b''
+        if request.qdcount != 1 or request.is_response:
+            return b''
+        question = request.questions[0]
+        # клиенту без EDNS0 - ответ без OPT, без DO - без RRSIG
+        key = question.key() + (edns,)
+        self.stats.seen(key[0])
+        response = self.dns_cache.get(
+            key, request.id, now, data[HEADER.size:request.questions_end])
+        if response is None:
+            self.stats.count(MISS)
+        else:
+            self.stats.cached(response, question.qtype, now)
+        return response
+
+    def handle(self, data, addr, now, extra):
+        # общий пул UDP-сокетов вместо TCP-соединения на каждый промах
+        response = self.forwarder.query(data)
+        request = parse_message(data, records=False)
+        self.stats.latency(UPSTREAM_PATH, request.questions[0].qtype, now)
+        if not response:
+            return b''  # форвардер не ответил: продолжения не будет
         try:
-            cursor.execute('INSERT INTO T_CACHE (K,V) VALUES (?,?)', (K, V))
-        except sqlite3.IntegrityError:
-            cursor.execute('UPDATE T_CACHE SET V = ? WHERE K = ?', (V, K))
-        finally:
-            cursor.close()
-
-
-class DNSServer(SocketServer.BaseRequestHandler):
-    allow_reuse_address = True
-    daemon_threads = True
-    dns_cache = cache()
-
-    def handle(self):
-        data, sk = self.request
-        if not data:
-            return
-        response = self._query(data)
-        if response:
-            sk.sendto(response, self.client_address)
+            self.dns_cache.put(
+                request.questions[0].key() + (edns_mode(data, request),),
+                response, parse_message(response))
+        except DNSError as e:
+            log.sample('WARNING  invalid response: {}', e)
+        return response
 
-    def _query(self, data):
-        ID, K = data[:2], data[2:]
-        V = self.dns_cache.get(K)
-        if V:
-            return ''.join([ID, V])
-        query = ''.join([struct.pack('>H', len(data)), data])
-        for s in dns:
-            sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sk.settimeout(5)
-            try:
-                sk.connect(s)
-                sk.send(query)
-                response = sk.recv(2048)
-            except Exception as e:
-                logging.error('connect %s:%i error:%s' % (s[0], s[1], e))
-                response = None
-            finally:
-                sk.close()
-            if response:
-                self.dns_cache.put(K, response[4:])
-                return response[2:]
+    def update_stats(self):
+        self.stats.update(self.forwarder, self.core, self.dns_cache)
 
 
 if __name__ == '__main__':
@@ -113,20 +98,33 @@ if __name__ == '__main__':
         sys.stderr.write('fork error:%s\n' % e)
         sys.exit(1)
     pid = os.getpid()
-    logging.info('start daemon, pid:%i' % pid)
+    log.log('INFO     start daemon, pid:{}', pid)
     with open(pidfile, 'w') as pf:
         pf.write(str(pid))
     try:
         gevent.monkey.patch_all(dns=gevent.version_info[0] >= 1)
-        logging.info('Using gevent')
+        log.log('INFO     Using gevent')
     except Exception:
-        logging.info('Using thread')
+        log.log('INFO     Using thread')
 
     try:
-        server = SocketServer.ThreadingUDPServer(('localhost', 53), DNSServer)
+        DNSServer.forwarder.start()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('localhost', 53))
+        stream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stream.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        stream.bind(('localhost', 53))
+        stream.listen(socket.SOMAXCONN)
+        handler = DNSServer()
+        server = ServerCore(sock, handler.lookup, handler.handle,
+                            workers=WORKERS, log=log, stream=stream)
+        handler.core = server
+        if METRICS_PORT:
+            handler.stats.serve('localhost', METRICS_PORT,
+                                handler.update_stats)
         server.serve_forever()
-        server.shutdown()
     except Exception as e:
-        logging.warn('daemon has exited: %s' % e)
+        log.log('WARNING  daemon has exited: {}', e)
     finally:
         os.remove(pidfile)
@@ -0,0 +1,191 @@
+""" Кэш отдельных записей (RRset) и сборка ответа из них.
+
+Из каждого ответа форвардера в хранилище попадают записи всех трех
+секций: AN, NS и AR. Например, после `dig mail.ru mx` в AR приходят
+A-записи почтовых серверов, и последующий `dig mxs.mail.ru` собирается
+из кэша без обращения к форвардеру.
+
+Не всем записям ответа можно верить (RFC 2181, 5.4.1):
+
+    * в секции AN берутся только записи имени из вопроса и цепочки
+      CNAME от него;
+    * в секции NS - только записи самого вопроса или его предков
+      (bailiwick); корня - только в ответе на вопрос о корне;
+    * в секции AR - только записи имен, на которые ссылаются принятые
+      записи NS, MX и CNAME (адреса серверов, glue). Чужие имена
+      (google.com в ответе про mail.ru) отбрасываются - иначе ими легко
+      отравить кэш. Зона вопроса для AR не годится: запись NS для ru.
+      в ответе про foo.mail.ru открыла бы весь .ru;
+    * у RRset есть ранг: AN с флагом AA, AN, NS, AR. Живой RRset не
+      заменяется данными ниже рангом.
+
+Записи индексируются по (имя владельца, тип, класс), имя - в нижнем
+регистре через точку (b'mxs.mail.ru'). rdata хранится в несжатом виде
+(так её отдает common.dnswire). При сборке ответа имена (включая имена в
+rdata типов из RFC 1035) снова сжимаются.
+"""
+
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.dnswire import (RCODE_NOERROR, TYPE_ANY,  # noqa: E402
+                            TYPE_CNAME, TYPE_MX, TYPE_NS, TYPE_OPT,
+                            MessageBuilder, read_name)
+
+MAX_CNAME_CHAIN = 8
+RANK_ADDITIONAL, RANK_AUTHORITY, RANK_ANSWER, RANK_AUTHORITATIVE = \
+    range(1, 5)
+# типы, в rdata которых имя, чьи адреса законны в AR: смещение имени
+TARGET_OFFSETS = {TYPE_NS: 0, TYPE_CNAME: 0, TYPE_MX: 2}
+
+
+def in_bailiwick(owner, qname):
+    """ owner - сам qname или его предок; корень - только для вопроса
+        о корне: иначе любой ответ мог бы подменить корневые NS """
+    if not owner:
+        return not qname
+    return qname == owner or qname.endswith(b'.' + owner)
+
+
+def answer_owners(message, qname):
+    """ Имена, записи которых законны в секции AN: вопрос и цепочка
+        CNAME от него """
+    cnames = {record.name.lower(): record.rdata
+              for record in message.answers if record.rtype == TYPE_CNAME}
+    owners = {qname}
+    name = qname
+    for _ in range(MAX_CNAME_CHAIN):
+        target = cnames.get(name)
+        if target is None:
+            break
+        name = read_name(target, 0)[0].lower()
+        owners.add(name)
+    return owners
+
+
+def target(record):
+    """ Имя из rdata NS, CNAME или MX в нижнем регистре, иначе None """
+    offset = TARGET_OFFSETS.get(record.rtype)
+    if offset is None:
+        return None
+    return read_name(record.rdata, offset)[0].lower()
+
+
+class RRset:
+    __slots__ = ('expires', 'rdatas', 'rank')
+
+    def __init__(self, expires, rdatas, rank) -> None:
+        self.expires = expires
+        self.rdatas = rdatas
+        self.rank = rank
+
+
+class RecordStore:
+    def __init__(self, max_entries=1 << 20) -> None:
+        self.max_entries = max_entries
+        self.rrsets = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.rrsets)
+
+    def add_message(self, message, now=None):
+        """ Кладем в хранилище записи разобранного ответа
+            (common.dnswire.Message), которым можно верить """
+        if message.rcode != RCODE_NOERROR or message.is_truncated or \
+                len(message.questions) != 1:
+            return
+        now = time.time() if now is None else now
+        qname = message.questions[0].name.lower()
+        owners = answer_owners(message, qname)
+        targets = set()  # имена, адресам которых верим в AR
+        sections = (
+            (message.answers, RANK_AUTHORITATIVE
+             if message.is_authoritative else RANK_ANSWER),
+            (message.authorities, RANK_AUTHORITY),
+            (message.additionals, RANK_ADDITIONAL),
+        )
+        grouped = {}
+        for records, rank in sections:
+            for record in records:
+                name = record.name.lower()
+                if rank >= RANK_ANSWER:
+                    trusted = name in owners
+                elif rank == RANK_AUTHORITY:
+                    trusted = in_bailiwick(name, qname)
+                else:
+                    trusted = name in targets
+                if record.rtype == TYPE_OPT or not trusted:
+                    continue
+                if rank > RANK_ADDITIONAL:
+                    pointed = target(record)
+                    if pointed is not None:
+                        targets.add(pointed)
+                key = (name, record.rtype, record.rclass)
+                ttl, rdatas, best = grouped.get(key, (record.ttl, [], rank))
+                if record.rdata not in rdatas:
+                    rdatas.append(record.rdata)
+                grouped[key] = (min(ttl, record.ttl), rdatas,
+                                max(best, rank))
+        for key, (ttl, rdatas, rank) in grouped.items():
+            if ttl <= 0:
+                continue
+            current = self.rrsets.get(key)
+            if current is not None and current.expires > now and \
+                    current.rank > rank:
+                continue  # данные ниже рангом не заменяют живой RRset
+            self.rrsets.pop(key, None)
+            self.rrsets[key] = RRset(now + ttl, rdatas, rank)
+        while len(self.rrsets) > self.max_entries:
+            self.rrsets.popitem(last=False)
+
+    def get(self, name, rtype, rclass, now):
+        """ (оставшийся ttl, список rdata) или None """
+        key = (name, rtype, rclass)
+        rrset = self.rrsets.get(key)
+        if rrset is None:
+            return None
+        if rrset.expires <= now:
+            del self.rrsets[key]
+            return None
+        self.rrsets.move_to_end(key)
+        return int(rrset.expires - now), rrset.rdatas
+
+    def resolve(self, qname, qtype, qclass, now=None):
+        """ Записи для секции ответа с проходом по цепочке CNAME,
+            None - если в кэше не хватает данных для полного ответа """
+        if qtype == TYPE_ANY:
+            return None
+        now = time.time() if now is None else now
+        answers = []
+        name = qname
+        for _ in range(MAX_CNAME_CHAIN):
+            found = self.get(name, qtype, qclass, now)
+            if found is not None:
+                ttl, rdatas = found
+                answers.extend((name, qtype, qclass, ttl, rdata)
+                               for rdata in rdatas)
+                return answers
+            found = self.get(name, TYPE_CNAME, qclass, now)
+            if found is None or qtype == TYPE_CNAME:
+                return None
+            ttl, rdatas = found
+            answers.append((name, TYPE_CNAME, qclass, ttl, rdatas[0]))
+            name = read_name(rdatas[0], 0)[0].lower()
+        return None
+
+
+def build_response(txid, flags, question, answers, builder=None):
+    """ Ответ, собранный из записей кэша (answers - результат
+        RecordStore.resolve). builder - переиспользуемый
+        common.dnswire.MessageBuilder потока, который отвечает """
+    builder = builder if builder is not None else MessageBuilder()
+    builder.reset()
+    builder.header(txid, flags, 1, len(answers))
+    builder.question(question.name, question.qtype, question.qclass)
+    for name, rtype, rclass, ttl, rdata in answers:
+        builder.record(name, rtype, rclass, ttl, rdata)
+    return builder.getvalue()
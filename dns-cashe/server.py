@@ -0,0 +1,344 @@
+""" Общее ядро серверов DNS (dns-evil.py, raw_.py).
+
+Один поток приема читает датаграммы и сразу, не передавая никуда,
+отвечает на то, что есть в кэше: lookup(data, addr, now) возвращает
+готовый ответ. Промахи (lookup вернул None) уходят в очередь
+фиксированного пула потоков-обработчиков handle(data, addr, now, extra).
+
+    * потоков столько, сколько задано при запуске, а не по одному на
+      датаграмму, как у socketserver.ThreadingUDPServer;
+    * очередь ограничена: если в ней уже backlog промахов, новый запрос
+      не ставится, а сразу получает SERVFAIL (rejected) - клиент
+      переспросит другой сервер, а задержка ответов на попадания не
+      растет вместе с очередью;
+    * put() ставит задачу без ограничения - для продолжений уже
+      принятых запросов (ответов форвардера): их число и так ограничено
+      принятыми, а ждать места в очереди поток форвардера не должен;
+    * ответ больше, чем клиент готов принять по UDP (512 байт или
+      размер из его OPT), уходит обрезанным с TC=1;
+    * TCP (RFC 7766), если передан слушающий сокет stream: по потоку на
+      соединение, не больше MAX_STREAMS. Запросы читаются подряд и идут
+      тем же путем, что и по UDP, ответы пишутся по готовности, в любом
+      порядке (pipelining). Соединение без запросов закрывается через
+      STREAM_IDLE секунд. Ответы пишет свой поток записи соединения из
+      очереди на STREAM_QUEUE ответов: клиент, который их не читает, не
+      задерживает обработчиков - при полной очереди соединение рвется.
+
+lookup выполняется в потоке приема и не должен блокироваться: никаких
+запросов к форвардеру, только кэш. Пустой ответ (b'') - не отвечать.
+handle возвращает ответ, b'' - ответа не будет, None - ответит
+продолжение, поставленное через put() с тем же addr.
+"""
+
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.dnswire import (FRAME_SIZE, HEADER,  # noqa: E402
+                            MAX_MESSAGE_SIZE, RCODE_SERVFAIL, UDP_PAYLOAD,
+                            DNSError, parse_message, truncate, udp_payload)
+
+WORKERS = 8
+BACKLOG = 1024
+MAX_STREAMS = 256
+STREAM_IDLE = 10  # RFC 7766, 6.2.3: порядка секунд
+STREAM_QUEUE = 256  # ответов, ждущих записи в одно соединение
+
+
+def response_flags(request, rcode=0):
+    """ QR=1, RA=1, opcode и RD из запроса """
+    return 0x8000 | 0x0080 | (request.flags & 0x7900) | rcode
+
+
+def error_response(raw, request, rcode):
+    """ Ответ с кодом ошибки и исходным вопросом """
+    flags = response_flags(request, rcode)
+    return struct.pack("!6H", request.id, flags,
+                       len(request.questions), 0, 0, 0) + \
+        raw[HEADER.size:request.questions_end]
+
+
+def recv_exactly(connection, size):
+    """ Ровно size байт из потока или None, если он закончился """
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(connection):
+    """ Сообщение из TCP: длина, затем само сообщение (RFC 1035, 4.2.2);
+        оно может прийти любыми кусками. None - клиент закрыл запись """
+    header = recv_exactly(connection, FRAME_SIZE)
+    if header is None:
+        return None
+    return recv_exactly(connection, int.from_bytes(header, 'big'))
+
+
+class StreamPeer(tuple):
+    """ Адрес TCP-клиента: (host, port), как у UDP, плюс соединение, в
+        которое пишутся ответы, очередь ответов на запись и число его
+        запросов у обработчиков """
+    def __new__(cls, address, connection, size=STREAM_QUEUE):
+        peer = super().__new__(cls, address)
+        peer.connection = connection
+        peer.outbox = queue.Queue(size)
+        peer.waiting = 0
+        peer.done = threading.Condition()
+        return peer
+
+    def queued(self):
+        with self.done:
+            self.waiting += 1
+
+    def send(self, response, answered=False):
+        """ Ответ в очередь записи, не блокируясь. False - очередь полна
+            (клиент не читает ответы), соединение разорвано. answered -
+            ответ обработчика """
+        frame = len(response).to_bytes(FRAME_SIZE, 'big') + response
+        try:
+            self.outbox.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.abort()
+            return False
+        finally:
+            if answered:
+                self.finished()
+
+    def finished(self):
+        """ Запрос, отданный обработчикам, завершен - с ответом или без """
+        with self.done:
+            self.waiting -= 1
+            self.done.notify_all()
+
+    def write(self):
+        """ Поток записи: ответы целиком, по одному, до None """
+        while True:
+            frame = self.outbox.get()
+            if frame is None:
+                return
+            try:
+                self.connection.sendall(frame)
+            except OSError:
+                # поток чтения увидит разрыв; очередь дочитываем, чтобы
+                # close() не ждал в ней места
+                self.abort()
+
+    def abort(self):
+        """ Разрыв соединения из любого потока: чтение вернет конец
+            потока, запись - ошибку """
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """ Конец ответов: поток записи допишет очередь и завершится """
+        self.outbox.put(None)
+
+    def drain(self, timeout):
+        """ Ждем ответов на запросы, уже отданные обработчикам """
+        with self.done:
+            self.done.wait_for(lambda: self.waiting <= 0, timeout)
+
+
+class ServerCore:
+    def __init__(self, sock, lookup, handle, workers=WORKERS,
+                 backlog=BACKLOG, log=None, stream=None,
+                 max_streams=MAX_STREAMS, stream_idle=STREAM_IDLE) -> None:
+        self.sock = sock
+        self.lookup = lookup
+        self.handle = handle
+        self.workers = workers
+        self.backlog = backlog
+        self.log = log or BufferedLog()
+        self.stream = stream  # слушающий TCP-сокет или None
+        self.streams = threading.BoundedSemaphore(max_streams)
+        self.stream_idle = stream_idle
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.running = False
+        self.inline = 0
+        self.dispatched = 0
+        self.rejected = 0
+        self.truncated = 0
+
+    def start(self):
+        """ Пул обработчиков, прием TCP и поток приема UDP в фоне """
+        self.start_threads()
+        receiver = threading.Thread(target=self.receive)
+        receiver.start()
+        self.threads.append(receiver)
+
+    def serve_forever(self):
+        """ Пул обработчиков и прием TCP в фоне, прием UDP - в вызвавшем
+            потоке """
+        self.start_threads()
+        self.receive()
+
+    def start_threads(self):
+        self.running = True
+        for _ in range(self.workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.threads.append(worker)
+        if self.stream is not None:
+            acceptor = threading.Thread(target=self.accept, daemon=True)
+            acceptor.start()
+            self.threads.append(acceptor)
+
+    def stop(self):
+        """ Прием завершится по таймауту сокета, обработчики - доделав
+            уже поставленные задачи """
+        self.running = False
+        for _ in range(self.workers):
+            self.tasks.put(None)
+
+    def put(self, task):
+        """ Задача (data, addr, now, extra) обработчикам без учета
+            backlog; addr None - отвечать некому """
+        self.tasks.put(task)
+
+    def dispatch(self, data, addr, now):
+        """ Ответ из lookup; None - запрос ушел обработчикам; SERVFAIL,
+            если очередь полна; b'' - не отвечать """
+        try:
+            response = self.lookup(data, addr, now)
+        except Exception as e:
+            self.log.sample('lookup error for {}: {!r}', addr[0], e)
+            return b''
+        if response is not None:
+            self.inline += 1
+            return response
+        if self.tasks.qsize() < self.backlog:
+            self.dispatched += 1
+            self.tasks.put((data, addr, now, None))
+            return None
+        self.rejected += 1
+        return self.overload(data)
+
+    def receive(self):
+        buffer = bytearray(MAX_MESSAGE_SIZE)
+        while self.running:
+            try:
+                size, addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.running:
+                    break
+                self.log.sample('receive error: {}', e)
+                continue
+            data = bytes(buffer[:size])
+            response = self.dispatch(data, addr, time.time())
+            if response:
+                self.send(response, addr, data)
+
+    def accept(self):
+        while self.running:
+            try:
+                connection, addr = self.stream.accept()
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.running:
+                    break
+                self.log.sample('accept error: {}', e)
+                continue
+            if not self.streams.acquire(blocking=False):
+                # соединений и так много: клиент повторит позже
+                connection.close()
+                continue
+            threading.Thread(target=self.serve_stream,
+                             args=(connection, addr), daemon=True).start()
+
+    def serve_stream(self, connection, addr):
+        """ Запросы одного TCP-клиента: следующий читается, не дожидаясь
+            ответа на предыдущий (RFC 7766, 6.2.1.1) """
+        peer = StreamPeer(addr[:2], connection)
+        writer = threading.Thread(target=peer.write, daemon=True)
+        writer.start()
+        try:
+            connection.settimeout(self.stream_idle)
+            while self.running:
+                data = read_frame(connection)
+                if data is None:
+                    break
+                response = self.dispatch(data, peer, time.time())
+                if response is None:
+                    peer.queued()
+                elif response:
+                    self.send(response, peer, data)
+            # клиент закрыл запись, но ответов еще ждет
+            peer.drain(self.stream_idle)
+        except OSError as e:
+            if not isinstance(e, socket.timeout):
+                self.log.sample('TCP client {} error: {}', addr[0], e)
+        finally:
+            peer.close()
+            writer.join()
+            connection.close()
+            self.streams.release()
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            try:
+                response = self.handle(*task)
+            except Exception as e:
+                self.log.sample('handler error: {!r}', e)
+                response = b''
+            # addr None - фоновая задача сервера
+            if response and task[1] is not None:
+                self.send(response, task[1], task[0], answered=True)
+            elif response is not None and isinstance(task[1], StreamPeer):
+                # ответа не будет: TCP-клиент не должен ждать его в drain
+                task[1].finished()
+
+    def send(self, response, addr, query, answered=False):
+        try:
+            if isinstance(addr, StreamPeer):
+                if not addr.send(response, answered):
+                    self.log.sample('TCP client {} does not read answers, '
+                                    'dropped', addr[0])
+                return
+            if len(response) > UDP_PAYLOAD:
+                response = self.fit(response, query)
+            self.sock.sendto(response, addr)
+        except OSError as e:
+            self.log.sample('send to {} failed: {}', addr[0], e)
+
+    def fit(self, response, query):
+        """ Ответ по UDP не больше, чем примет автор запроса """
+        try:
+            if len(response) <= udp_payload(parse_message(query)):
+                return response
+            message = parse_message(response, records=False)
+        except DNSError:
+            return response
+        self.truncated += 1
+        return truncate(response, message)
+
+    def overload(self, data):
+        """ SERVFAIL на запрос, не поместившийся в очередь """
+        try:
+            request = parse_message(data, records=False)
+        except DNSError:
+            return b''
+        if request.is_response:
+            return b''
+        return error_response(data, request, RCODE_SERVFAIL)
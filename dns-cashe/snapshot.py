@@ -0,0 +1,185 @@
+""" Снимок кэша ответов на диске для быстрого теплого старта.
+
+Формат файла (все числа - network order):
+
+    заголовок  HEADER: magic, версия, время записи, число записей,
+               число слотов индекса, смещение индекса, крайний срок
+               (максимальный expires среди записей)
+    записи     RECORD (expires, stored, qtype, qclass, длины имени и
+               ответа, число TTL, режим EDNS0 ключа), затем пары
+               (смещение, ttl) TTL_ENTRY, имя в нижнем регистре и ответ
+               форвардера целиком
+    индекс     открытая адресация по crc32 ключа, в слоте - смещение
+               записи (0 - пусто), число слотов - степень двойки
+
+Файл открывается через mmap и ничего не разбирается заранее: запуск с
+миллионами записей занимает столько же, сколько открытие файла. Запись
+читается из отображения при первом промахе по ней (DNSCache.get) и
+переносится в память. Сроки в записях абсолютные (time.time()), поэтому
+TTL после перезапуска пересчитываются сами собой: клиент увидит время,
+оставшееся с момента ответа форвардера.
+
+Снимок пишется во временный файл и подменяет старый через os.replace:
+упавшая запись не портит предыдущий снимок.
+"""
+
+import array
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from dnscache import Entry
+
+HEADER = struct.Struct('!4sHdIIQd')
+RECORD = struct.Struct('!ddHHHHHB')
+TTL_ENTRY = struct.Struct('!HI')
+KEY = struct.Struct('!HHB')
+MAGIC = b'DNSC'
+VERSION = 2
+SLOT_SIZE = 8
+WRITE_CHUNK = 1 << 14  # кусков bytes на одну запись в файл
+
+
+def key_hash(name, qtype, qclass, edns):
+    return zlib.crc32(KEY.pack(qtype, qclass, edns), zlib.crc32(name))
+
+
+class Snapshot:
+    """ Снимок, отображенный в память; читается только по запросу """
+    def __init__(self, path) -> None:
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.saved, self.count, self.slots, \
+                self.index_offset, self.deadline = \
+                HEADER.unpack_from(self.mm)
+        except struct.error:
+            self.close()
+            raise ValueError('{}: truncated snapshot'.format(path))
+        if magic != MAGIC or version != VERSION or \
+                self.index_offset + self.slots * SLOT_SIZE > len(self.mm):
+            self.close()
+            raise ValueError('{}: not a cache snapshot'.format(path))
+        self.mask = self.slots - 1
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mm.close()
+
+    def get(self, key):
+        """ Entry по ключу (имя, тип, класс, режим EDNS0) или None """
+        if not self.slots:
+            return None
+        name, qtype, qclass, edns = key
+        slot = key_hash(name, qtype, qclass, edns) & self.mask
+        for _ in range(self.slots):
+            offset, = struct.unpack_from(
+                '!Q', self.mm, self.index_offset + slot * SLOT_SIZE)
+            if not offset:
+                return None
+            record = RECORD.unpack_from(self.mm, offset)
+            if record[2] == qtype and record[3] == qclass and \
+                    record[7] == edns:
+                start = offset + RECORD.size + record[6] * TTL_ENTRY.size
+                if self.mm[start:start + record[4]] == name:
+                    return self.entry(offset, record)[1]
+            slot = (slot + 1) & self.mask
+        return None
+
+    def entry(self, offset, record):
+        """ (ключ, Entry) записи по смещению """
+        expires, stored, qtype, qclass, name_size, size, count, edns = \
+            record
+        offset += RECORD.size
+        ttls = [TTL_ENTRY.unpack_from(self.mm, offset + i * TTL_ENTRY.size)
+                for i in range(count)]
+        offset += count * TTL_ENTRY.size
+        name = self.mm[offset:offset + name_size]
+        offset += name_size
+        response = self.mm[offset:offset + size]
+        # срок prefetch назначит DNSCache по своей доле TTL
+        return (name, qtype, qclass, edns), Entry(expires, stored, response,
+                                                  ttls, float('inf'))
+
+    def __iter__(self):
+        """ Все записи подряд: (ключ, Entry) """
+        offset = HEADER.size
+        for _ in range(self.count):
+            record = RECORD.unpack_from(self.mm, offset)
+            yield self.entry(offset, record)
+            offset += RECORD.size + record[6] * TTL_ENTRY.size + \
+                record[4] + record[5]
+
+
+def load(path, log):
+    """ Снимок или None, если файла нет или он поврежден """
+    try:
+        return Snapshot(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log.log('snapshot {} skipped: {}', path, e)
+        return None
+
+
+def save(path, items, now):
+    """ Записываем (ключ, Entry) в снимок; возвращает число записей """
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        count = _write(tmp, items, now)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    os.replace(tmp, path)
+    return count
+
+
+def _write(tmp, items, now):
+    offsets = array.array('Q')
+    hashes = array.array('L')
+    deadline = 0
+    with open(tmp, 'wb') as f:
+        chunk = [bytes(HEADER.size)]
+        offset = HEADER.size
+        for (name, qtype, qclass, edns), entry in items:
+            ttls = entry.ttls
+            response = entry.response
+            record = RECORD.pack(entry.expires, entry.stored, qtype, qclass,
+                                 len(name), len(response), len(ttls), edns)
+            chunk.append(record)
+            chunk.extend(TTL_ENTRY.pack(position, ttl)
+                         for position, ttl in ttls)
+            chunk.append(name)
+            chunk.append(response)
+            offsets.append(offset)
+            hashes.append(key_hash(name, qtype, qclass, edns))
+            if entry.expires > deadline:
+                deadline = entry.expires
+            offset += RECORD.size + len(ttls) * TTL_ENTRY.size + \
+                len(name) + len(response)
+            if len(chunk) >= WRITE_CHUNK:
+                f.write(b''.join(chunk))
+                chunk.clear()
+        f.write(b''.join(chunk))
+        slots = 1
+        while slots < 2 * len(offsets):
+            slots <<= 1
+        index = array.array('Q', bytes(slots * SLOT_SIZE))
+        mask = slots - 1
+        for record, hashed in zip(offsets, hashes):
+            slot = hashed & mask
+            while index[slot]:
+                slot = (slot + 1) & mask
+            index[slot] = record
+        if sys.byteorder == 'little':
+            index.byteswap()
+        f.write(index.tobytes())
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, now, len(offsets), slots,
+                            offset, deadline))
+    return len(offsets)
@@ -15,7 +15,9 @@ UDP 123 SNTP
 
 
 import argparse  # для разбора аргументов
+import os
 import socket
+import sys
 import threading
 from traceback import print_exc
 from typing import List, Tuple
@@ -26,7 +28,12 @@ import poplib
 from smtplib import SMTP_SSL
 
 import struct
-import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.dnswire import (DNSError, encode_query,  # noqa: E402
+                            parse_message)
 
 
 TIMEOUT = 3
@@ -71,7 +78,8 @@ def scan(tcp: bool, udp: bool, host: str, ports: List[str]):
 
 
 class Scanner:
-    def __init__(self, tcp, udp, host: str, ports, timeout=1.0, t_count=10):
+    def __init__(self, tcp, udp, host: str, ports, timeout=1.0, t_count=10,
+                 log=None):
         self.tcp = tcp
         self.udp = udp
         self.host = host
@@ -85,6 +93,8 @@ class Scanner:
         # перечень проверяемых портов в текущий момент
         self._ports_being_checked = []
         self._next_port, self._last_port = ports
+        # вывод через фоновый писатель, чтобы не печатать под блокировкой
+        self.log = log or BufferedLog()
 
     def run(self):
         try:
@@ -101,7 +111,7 @@ class Scanner:
                 for i in range(slots_available):  # запустить пачку потоков
                     self.start_another_thread()
         except AllThreadsStarted:
-            print("All threads started ...")
+            self.log.log("All threads started ...")
         except Exception:
             print_exc()
 
@@ -145,7 +155,7 @@ class Scanner:
             protocol = self.check_socket_protocol(s, port, 'tcp')
             with self._lock:
                 self._ports_active.append(port)
-                print("TCP: {} {}".format(port, protocol))
+            self.log.log("TCP: {} {}", port, protocol)
         except socket.timeout:
             return
         finally:
@@ -162,7 +172,7 @@ class Scanner:
             protocol = self.check_socket_protocol(s, port, 'udp')
             with self._lock:
                 self._ports_active.append(port)
-                print('UDP {} {}'.format(port, protocol))
+            self.log.log('UDP {} {}', port, protocol)
         except socket.timeout:
             return
         finally:
@@ -202,30 +212,15 @@ class Scanner:
             pkg = self._build_dns_packet()
             s.sendto(pkg, (self.host, port))
             response = s.recv(1024)
-        except Exception:
+            message = parse_message(response, records=False)
+        except (OSError, DNSError):
             return False
-        if len(response) > 0:  # TODO: check response
-            return True
-        return False
+        # ответ на наш вопрос с тем же идентификатором
+        return message.is_response and \
+            message.id == struct.unpack_from('>H', pkg)[0]
 
     def _build_dns_packet(self):
-        url = 'www.google.com'
-        randint = random.randint(0, 65535)
-        packet = struct.pack(">H", randint)  # Query Ids (Just 1 for now)
-        packet += struct.pack(">H", 0x0100)  # Flags
-        packet += struct.pack(">H", 1)  # Questions
-        packet += struct.pack(">H", 0)  # Answers
-        packet += struct.pack(">H", 0)  # Authorities
-        packet += struct.pack(">H", 0)  # Additional
-        split_url = url.split(".")
-        for part in split_url:
-            packet += struct.pack("B", len(part))
-            for s in part:
-                packet += struct.pack('c', s.encode())
-        packet += struct.pack("B", 0)  # End of String
-        packet += struct.pack(">H", 1)  # Query Type
-        packet += struct.pack(">H", 1)  # Query Class
-        return packet
+        return encode_query(b'www.google.com')
 
     def _is_http(self, s):
         """ А может HTTP """
@@ -339,5 +334,5 @@ if __name__ == "__main__":
                      ===> фильтрует входящие пакеты <===
                 * опять же "аккуратно" записывает порт в список активных
                     (self._ports_active)
-                * "аккуратно" выводит сообщение на экран
+                * передает сообщение фоновому писателю журнала (buflog)
 """
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from SNTPserver import ANSWERED, LATENCY, METRICS, SNTPserver
+
+
+class SNTPprotocol(asyncio.DatagramProtocol):
+    """ Обработчик датаграмм: отвечает прямо в datagram_received,
+        без передачи запроса в другой поток """
+    def __init__(self, server) -> None:
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # время приема фиксируем до любой другой работы
+        recive_time = time.time()
+        self.server.log.client(addr[0])
+        response = self.server.answer(data, len(data), addr, recive_time)
+        if response is not None:
+            # если отправить сразу не удалось, транспорт сам копирует
+            # данные, так что общий буфер ответа можно переиспользовать
+            self.transport.sendto(response, addr)
+            self.server.counters[ANSWERED] += 1
+            METRICS.observe(
+                self.server.counters, LATENCY, time.time() - recive_time)
+
+    def error_received(self, exc):
+        # ICMP port unreachable от прошлого ответа - не повод падать
+        pass
+
+
+class AsyncSNTPserver(SNTPserver):
+    """ Вариант сервера на asyncio: один цикл событий вместо потоков,
+        удобно встраивать рядом с другими asyncio-сервисами """
+    def __init__(self, sock, delay, counters=None, limiter=None,
+                 log=None) -> None:
+        super().__init__(sock, delay, batch_size=0, counters=counters,
+                         limiter=limiter, log=log)
+        self.loop = None
+        self.stopped = None
+
+    def run(self):
+        self.log.log("SNTP server start (asyncio)")
+        self.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        """ Можно вызывать из обработчика сигнала или другого потока """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._set_stopped)
+
+    def _set_stopped(self):
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def serve(self):
+        """ Корутина для запуска внутри уже работающего цикла событий """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: SNTPprotocol(self), sock=self.sock)
+        try:
+            await self.stopped  # работаем до вызова stop()
+        finally:
+            transport.close()
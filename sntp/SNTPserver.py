@@ -1,72 +1,297 @@
-import queue
+import math
+import os
 import time
 import select
+import socket
 import struct
-# import sys
+import sys
 import threading
 
+from ratelimit import ALLOW, KOD, pack_ipv4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common.buflog import BufferedLog  # noqa: E402
+from common.metrics import Metrics  # noqa: E402
+
+
+# Заранее скомпилированные структуры пакета, чтобы не разбирать формат
+# на каждый запрос.
+# !BBbb3L4Q: LI/VN/mode, stratum, poll (знаковый), precision (знаковый),
+# root delay, root dispersion, ref id и 4 временные метки по 64 бита
+NTP_PACKET = struct.Struct('!BBbb3L4Q')
+NTP_TIMESTAMP = struct.Struct('!Q')
+# originate, recive и transmit идут подряд в конце пакета
+NTP_REPLY_TIMES = struct.Struct('!3Q')
+ORIGINATE_OFFSET = 24
+TRANSMIT_OFFSET = 40
+NTP_DELTA = 2208988800  # секунд между 1900-01-01 (NTP) и 1970-01-01 (unix)
+NTP_FRAC = 1 << 32      # единица дробной части временной метки
+
+BATCH_SIZE = 64  # максимум датаграмм, обрабатываемых за одно пробуждение
+RECV_SIZE = 1024
+SELECT_TIMEOUT = 0.5  # как часто проверяем флаг остановки
+REF_PERIOD = 64  # период "коррекции часов" для reference timestamp, секунд
+
+KOD_RATE = int.from_bytes(b'RATE', 'big')  # ref_id для Kiss-o'-Death
+
+# Временные метки приема от ядра (Linux). В модуле socket константы
+# SO_TIMESTAMPNS обычно нет, а её значение (asm/socket.h) зависит от
+# архитектуры: берем из таблицы, на прочих метки ядра недоступны.
+# Метка приходит как struct timespec (два long)
+SO_TIMESTAMPNS_BY_ARCH = dict.fromkeys(
+    ('x86_64', 'i386', 'i486', 'i586', 'i686', 'aarch64', 'armv6l',
+     'armv7l', 'armv8l', 'ppc', 'ppc64', 'ppc64le', 's390x', 'riscv64',
+     'loongarch64'), 35)
+SO_TIMESTAMPNS_BY_ARCH.update(sparc=0x21, sparc64=0x21, parisc=0x4013,
+                              parisc64=0x4013)
+TIMESPEC = struct.Struct('@ll')
+
+# Метрики сервера: все счетчики - ячейки одного заранее выделенного
+# массива (см. common/metrics.py), первые ячейки - сводка по датаграммам
+METRICS = Metrics()
+COUNTERS = ('received', 'answered', 'invalid', 'limited')
+PACKETS = METRICS.counter(
+    'sntp_packets_total', 'Datagrams by outcome',
+    ['kind="{}"'.format(kind) for kind in COUNTERS])
+RECEIVED, ANSWERED, INVALID, LIMITED = range(PACKETS, PACKETS + len(COUNTERS))
+# индекс ячейки - младшие 6 бит первого байта (VN << 3 | mode)
+REQUESTS = METRICS.counter(
+    'sntp_requests_total', 'Valid requests by version and mode',
+    ['version="{}",mode="{}"'.format(vn, mode)
+     for vn in range(8) for mode in range(8)])
+BATCH_DEPTH = METRICS.gauge(
+    'sntp_batch_depth', 'Datagrams drained on the last wakeup')
+LATENCY = METRICS.histogram(
+    'sntp_response_latency_seconds', 'Receive-to-send latency',
+    (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1))
+RX_SKEW = METRICS.histogram(
+    'sntp_rx_stamp_skew_seconds', 'User-space minus kernel receive time',
+    (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01))
+
+
+def pack_first_byte(li, vn, mode):
+    """ Собираем первый байт пакета: LI (2 бита), VN (3 бита), mode (3) """
+    return (li & 0b11) << 6 | (vn & 0b111) << 3 | mode & 0b111
+
+
+def unpack_first_byte(num):
+    """ Разбираем первый байт пакета на LI, VN и mode """
+    return num >> 6, (num >> 3) & 0b111, num & 0b111
+
+
+def time_to_sntp(timestamp):
+    """ Перевод unix-времени (float) в 64-битную метку NTP (32.32) """
+    sec = math.floor(timestamp)
+    frac = int((timestamp - sec) * NTP_FRAC)
+    return (sec + NTP_DELTA) << 32 | frac
+
+
+def sntp_to_time(timestamp):
+    """ Обратный перевод 64-битной метки NTP в unix-время """
+    return (timestamp >> 32) - NTP_DELTA + (timestamp & 0xFFFFFFFF) / NTP_FRAC
+
+
+def kernel_stamp_option():
+    """ (SO_TIMESTAMPNS, размер буфера вспомогательных данных recvmsg)
+        или None, если метки ядра на этой платформе недоступны """
+    if not sys.platform.startswith('linux') or \
+            not hasattr(socket, 'CMSG_SPACE'):
+        return None
+    option = getattr(socket, 'SO_TIMESTAMPNS', None)
+    if option is None:
+        option = SO_TIMESTAMPNS_BY_ARCH.get(os.uname().machine)
+    if option is None:
+        return None
+    return option, socket.CMSG_SPACE(TIMESPEC.size)
+
+
+def enable_kernel_stamps(sock):
+    """ Включаем метки ядра на сокете; возвращает (SO_TIMESTAMPNS,
+        размер буфера вспомогательных данных) для recvmsg """
+    option = kernel_stamp_option()
+    if option is None:
+        raise OSError('kernel receive timestamps are not supported '
+                      'on this platform')
+    sock.setsockopt(socket.SOL_SOCKET, option[0], 1)
+    return option
+
+
+def kernel_stamp(ancdata, option):
+    """ Время приема из вспомогательных данных recvmsg, None если нет.
+        option - SO_TIMESTAMPNS из enable_kernel_stamps """
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == option:
+            sec, nsec = TIMESPEC.unpack_from(data)
+            return sec + nsec * 1e-9
+    return None
+
 
 class SNTPserver:
     """ Класс с описанием сервера,
         должен делать 2 вещи:
             1. слушать обращения
             2. отвечать на обращения
+        Оба шага выполняются в одном потоке: за одно пробуждение select
+        вычитываем из сокета все готовые датаграммы (аналог recvmmsg),
+        пачкой готовим ответы и сразу же их отправляем
     """
-    def __init__(self, sock, delay) -> None:
+    def __init__(self, sock, delay, batch_size=BATCH_SIZE,
+                 counters=None, limiter=None, log=None,
+                 kernel_stamps=False) -> None:
         self.sock = sock
         self.delay = delay
-        self.task = queue.Queue()
+        # брать время приема из SO_TIMESTAMPNS, а не из time.time()
+        self.kernel_stamps = kernel_stamps
+        self.stamp_option = self.anc_size = None  # см. serve_forever
+        self.log = log or BufferedLog()
+        self.limiter = limiter  # ratelimit.RateLimiter или None
+        self.batch_size = batch_size
+        self.running = False
+        # ячейки METRICS можно передать снаружи (например, разделяемую
+        # между процессами память), по умолчанию - свой массив
+        self.counters = counters if counters is not None else \
+            METRICS.allocate()
+        # буферы приема и описания полученных датаграмм выделяются один раз
+        self.in_buffers = [bytearray(RECV_SIZE) for _ in range(batch_size)]
+        self.tasks = [None] * batch_size
+        # буфер ответа переиспользуется: в нём лежит заготовка ответа,
+        # на каждый запрос переписываются только три временные метки
+        self.out_buffer = bytearray(NTP_PACKET.size)
+        self.ref_time = None
+        # Kiss-o'-Death "RATE": LI=3, stratum=0, меняется только originate
+        kod = SNTPpack(delay, stratum=0, version=4, mode=4)
+        kod.LI = 3
+        kod.ref_id = KOD_RATE
+        self.kod_buffer = bytearray(kod.create_template())
 
     def run(self):
         """ Поднять сервер,
             слушать подключения/запросы,
             врать в ответ
         """
-        print("SNTP server start")
-        receiver = threading.Thread(target=self.listen_socket)
+        self.log.log("SNTP server start")
+        receiver = threading.Thread(target=self.serve_forever)
         receiver.start()
-        sender = threading.Thread(target=self.send_response)
-        sender.start()
+
+    def serve_forever(self):
+        """ Обслуживать запросы в текущем потоке до вызова stop() """
+        self.running = True
+        self.sock.setblocking(False)
+        if self.kernel_stamps:
+            self.stamp_option, self.anc_size = \
+                enable_kernel_stamps(self.sock)
+        self.listen_socket()
+
+    def stop(self):
+        self.running = False
 
     def listen_socket(self):
-        while True:
-            timeout = 3
-            ready_to_read, _, _ = select.select([self.sock], [], [], timeout)
+        while self.running:
+            ready_to_read, _, _ = select.select(
+                [self.sock], [], [], SELECT_TIMEOUT)
             if ready_to_read:
-                self.add_task(ready_to_read)
+                count = self.add_task()
+                self.counters[BATCH_DEPTH] = count
+                self.send_response(count)
+
+    def add_task(self):
+        """ Вычитываем все готовые датаграммы (не больше batch_size),
+            возвращаем их количество """
+        receive = self.recv_kernel_stamp if self.kernel_stamps \
+            else self.recv
+        count = 0
+        while count < self.batch_size:
+            try:
+                task = receive(self.in_buffers[count])
+            except BlockingIOError:
+                break
+            except ConnectionError:
+                # ICMP port unreachable от прошлого ответа - пропускаем
+                continue
+            self.log.client(task[1][0])
+            self.tasks[count] = task
+            count += 1
+        return count
+
+    def recv(self, buffer):
+        nbytes, addr = self.sock.recvfrom_into(buffer)
+        return nbytes, addr, time.time()
 
-    def add_task(self, ready_to_read):
-        for client in ready_to_read:
-            pack_sntp, addr = client.recvfrom(1024)
-            print("Connected: {}".format(addr[0]))
-            self.task.put((pack_sntp, addr, time.time()))
+    def recv_kernel_stamp(self, buffer):
+        """ Прием через recvmsg: время приема ставит ядро, до очередей
+            и планировщика. Расхождение с time.time() идет в RX_SKEW """
+        nbytes, ancdata, _, addr = self.sock.recvmsg_into([buffer],
+                                                          self.anc_size)
+        now = time.time()
+        stamp = kernel_stamp(ancdata, self.stamp_option)
+        if stamp is None:
+            return nbytes, addr, now
+        METRICS.observe(self.counters, RX_SKEW, max(0.0, now - stamp))
+        return nbytes, addr, stamp
 
     def prepare_response(self, request, recive_time):
-        return SNTPpack(self.delay,
-                        stratum=3,
-                        version=4,  # request.version,
-                        mode=4,  # 4 - сервер, 3 - клиент
-                        # время клиента
-                        originate_time=request.transmit_timestamp,
-                        # время сервера + дельта
-                        recive_time=recive_time + self.delay
-                        )
-
-    def send_response(self):
-        """ Если в очереди есть задания - обрабатываем их """
-        while True:
+        """ Ответ собирается в self.out_buffer из заготовки.
+            Заготовка (и reference timestamp в ней) обновляется раз в
+            REF_PERIOD секунд, остальное время меняются только метки """
+        ref_time = recive_time - recive_time % REF_PERIOD
+        if ref_time != self.ref_time:
+            self.ref_time = ref_time
+            self.out_buffer[:] = SNTPpack.reply_template(
+                self.delay,
+                stratum=3,
+                version=4,  # request.version,
+                ref_time=ref_time)
+        NTP_REPLY_TIMES.pack_into(
+            self.out_buffer, ORIGINATE_OFFSET,
+            # время клиента
+            NTP_TIMESTAMP.unpack_from(request, TRANSMIT_OFFSET)[0],
+            # время сервера + дельта
+            time_to_sntp(recive_time + self.delay),
+            # время отправки берется последним, сразу за ним идет sendto
+            time_to_sntp(time.time() + self.delay))
+        return self.out_buffer
+
+    def answer(self, data, nbytes, addr, recive_time):
+        """ Проверяем запрос и собираем ответ в self.out_buffer,
+            None - если запрос некорректный или отброшен ограничителем """
+        self.counters[RECEIVED] += 1
+        if self.limiter is not None:
+            # до любого разбора пакета
+            verdict = self.limiter.check(pack_ipv4(addr[0]), recive_time)
+            if verdict != ALLOW:
+                self.counters[LIMITED] += 1
+                if verdict == KOD and nbytes >= NTP_PACKET.size:
+                    return self.kod_response(data)
+                return None
+        if nbytes < NTP_PACKET.size:
+            self.counters[INVALID] += 1
+            self.log.sample('Invalid SNTP-packet format')
+            return None
+        self.counters[REQUESTS + (data[0] & 0x3F)] += 1
+        return self.prepare_response(data, recive_time)
+
+    def kod_response(self, request):
+        NTP_TIMESTAMP.pack_into(
+            self.kod_buffer, ORIGINATE_OFFSET,
+            NTP_TIMESTAMP.unpack_from(request, TRANSMIT_OFFSET)[0])
+        return self.kod_buffer
+
+    def send_response(self, count):
+        """ Готовим и отправляем ответы на первые count датаграмм пачки """
+        for i in range(count):
+            nbytes, req_addr, req_time = self.tasks[i]
+            response = self.answer(
+                self.in_buffers[i], nbytes, req_addr, req_time)
+            if response is None:
+                continue
             try:
-                if self.task.empty():
-                    time.sleep(1)
-                # print("Отправляем клиенту ответ")
-                req, req_addr, req_time = self.task.get(timeout=1)
-                request = SNTPpack()
-                request.parse_package(req)  # разбираем запрос клиента
-                response = self.prepare_response(
-                    request, req_time).create_package()  # готовим ответ
                 self.sock.sendto(response, req_addr)  # отправляем
-            except queue.Empty:
+            except (BlockingIOError, ConnectionError):
+                # буфер отправки переполнен или клиент уже ушел
                 continue
+            self.counters[ANSWERED] += 1
+            METRICS.observe(self.counters, LATENCY, time.time() - req_time)
 
 
 class SNTPpack():
@@ -100,6 +325,9 @@ class SNTPpack():
         'broadcast': 5
         }
 
+    # заготовки ответов: (delay, stratum, version) -> (ref_time, пакет)
+    _templates = {}
+
     def __init__(
         self, delay=0, stratum=3, version=4, mode=4, originate_time=0, 
         recive_time=0):
@@ -119,68 +347,80 @@ class SNTPpack():
         self.recive_timestamp = recive_time  # время сервера + дельта
         self.transmit_timestamp = 0
 
-    def parse_package(self, data):
+    def parse_package(self, data, offset=0):
+        """ Разбор пакета из bytes/bytearray/memoryview без копирования.
+            Возвращает True, если пакет удалось разобрать """
         try:
-            # !4B3L4Q == !BBBBLLLQQQQ - структура данных
-            size = struct.calcsize('!4B3L4Q')
-            unpacked = struct.unpack('!4B3L4Q', data[:size])
-            self.LI, self.VN, self.mode = self.parse_first_byte(unpacked[0])
-            self.ref_timestamp = struct.unpack('!Q', data[16:24])[0]
-            # self.originate_timestamp = struct.unpack('!Q', data[24:32])[0]
-            # self.recive_timestamp = struct.unpack('!Q', data[32:40])[0]
-            self.transmit_timestamp = struct.unpack('!Q', data[40:48])[0]
-            # print(self.transmit_timestamp)
-        except BaseException:
+            (first_byte, self.stratum, self.poll, self.precision,
+             self.root_delay, self.root_dispersion, self.ref_id,
+             self.ref_timestamp, self.originate_timestamp,
+             self.recive_timestamp, self.transmit_timestamp
+             ) = NTP_PACKET.unpack_from(data, offset)
+        except struct.error:
             print('Invalid SNTP-packet format')
+            return False
+        self.LI, self.VN, self.mode = unpack_first_byte(first_byte)
+        return True
 
     def parse_first_byte(self, num):
         """ Разбираем побитово первый байт """
-        # переводим число в строку с "бинарным" видом '00011011'
-        b = bin(num)[2:].rjust(8, '0')
-        li = int(b[:2], 2)      # первые 2 бита
-        vn = int(b[2:5], 2)     # следующие 3 бита
-        mode = int(b[5:], 2)    # оставшиеся 3 бита
-        return li, vn, mode
-
-    def create_package(self):
-        li = self.num_to_bin(self.LI, 2)
-        vn = self.num_to_bin(self.VN, 3)
-        mode = self.num_to_bin(self.mode, 3)
-        start_of_package = '{}{}{}'.format(li, vn, mode)
-        first_byte = int(start_of_package, 2)
+        return unpack_first_byte(num)
 
+    def create_package(self, buffer=None, offset=0):
+        """ Собираем пакет ответа.
+            Если передан buffer (bytearray/memoryview не короче 48 байт),
+            пакет пишется в него через pack_into и возвращается сам buffer,
+            иначе возвращаются новые bytes """
         self.transmit_timestamp = time.time() + self.delay
-        self.ref_timestamp = self.convert_time_to_sntp(
-            self.transmit_timestamp)
-        sntp_recive_timestamp = self.convert_time_to_sntp(
-            self.recive_timestamp)
-
-        package = struct.pack(
-            '!4B3L2LQ4L',
-            first_byte,  # LI + VN + MODE
+        # время последней коррекции: клиенту на это поле фиолетово,
+        # поэтому впишем нули - всё равно работает
+        fields = (
+            pack_first_byte(self.LI, self.VN, self.mode),
             self.stratum,
             self.poll,
             self.precision,
             self.root_delay,
             self.root_dispersion,
             self.ref_id,
-            # время отправки пакета + дельта (по идее здесь должно быть время 
-            # последней коррекции, и вроде как клиенту на это поле фиолетово,
-            # поэтому впишем нули - всё равно работает)
-            # *self.ref_timestamp,  
-            0, 0,
+            0,
             self.originate_timestamp,  # время клиента из запроса
-            *sntp_recive_timestamp,  # время получения пакета сервером
-            *self.ref_timestamp  # время отправки пакета + дельта
+            time_to_sntp(self.recive_timestamp),  # время получения пакета
+            time_to_sntp(self.transmit_timestamp)  # время отправки + дельта
             )
-        return package
+        if buffer is None:
+            return NTP_PACKET.pack(*fields)
+        NTP_PACKET.pack_into(buffer, offset, *fields)
+        return buffer
+
+    def create_template(self, ref_time=None):
+        """ Пакет с постоянными полями и временем последней коррекции
+            (без ref_time - нулевым), метки originate/recive/transmit
+            нулевые """
+        return NTP_PACKET.pack(
+            pack_first_byte(self.LI, self.VN, self.mode),
+            self.stratum,
+            self.poll,
+            self.precision,
+            self.root_delay,
+            self.root_dispersion,
+            self.ref_id,
+            0 if ref_time is None else time_to_sntp(ref_time + self.delay),
+            0, 0, 0)
 
-    def num_to_bin(self, num, length):
-        return bin(num)[2:].rjust(length, '0')
+    @classmethod
+    def reply_template(cls, delay, stratum=3, version=4, ref_time=0):
+        """ Заготовка ответа сервера, пересобирается только при смене
+            ref_time """
+        key = (delay, stratum, version)
+        cached = cls._templates.get(key)
+        if cached is None or cached[0] != ref_time:
+            template = cls(delay, stratum, version, mode=4).create_template(
+                ref_time)
+            cached = cls._templates[key] = (ref_time, template)
+        return cached[1]
 
     def convert_time_to_sntp(self, time):
-        """ Перевод времени в sntp формат (поправка на +70 лет) """
-        time_shift = 2208988800
-        sec, mill_sec = str(time + time_shift).split('.')
-        mill_sec = float('0.{}'.format(mill_sec)) * 2 ** 32
-        return int(sec), int(mill_sec)
+        """ Перевод времени в sntp формат (поправка на +70 лет),
+            возвращает пару (секунды, дробная часть) """
+        timestamp = time_to_sntp(time)
+        return timestamp >> 32, timestamp & 0xFFFFFFFF
@@ -0,0 +1,139 @@
+import mmap
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from SNTPserver import COUNTERS, METRICS, RECEIVED
+from common.metrics import serve_metrics
+
+
+class SNTPworkers:
+    """ Пул процессов-обработчиков.
+        Каждый процесс открывает свой сокет на том же порту с
+        SO_REUSEPORT, и ядро само распределяет датаграммы между ними.
+        Ячейки метрик процессов лежат в общей анонимной памяти (mmap),
+        родитель собирает их в одну таблицу и отдает суммарный /metrics.
+        run() возвращает 1, если хоть один процесс завершился с ошибкой.
+    """
+    def __init__(self, server_class, delay, host, port, workers,
+                 stats_interval=0, metrics_port=0, **server_kwargs) -> None:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError('SO_REUSEPORT is not supported on this platform')
+        self.server_class = server_class
+        self.delay = delay
+        self.address = (host, port)
+        self.workers = workers
+        self.stats_interval = stats_interval
+        self.metrics_port = metrics_port
+        # после fork у каждого процесса своя копия (например, limiter)
+        self.server_kwargs = server_kwargs
+        self.pids = []
+        self.failed = []  # (pid, код завершения) упавших процессов
+        width = METRICS.size * 8
+        self.shared = mmap.mmap(-1, workers * width)
+        self.counters = [
+            METRICS.allocate(
+                memoryview(self.shared)[worker * width:(worker + 1) * width])
+            for worker in range(workers)]
+        self.stopping = False
+
+    def run(self):
+        print("SNTP server start, workers: {}".format(self.workers))
+        for worker in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self.worker(worker)
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    # os._exit не сбрасывает буферы stdio
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+            self.pids.append(pid)
+
+        if self.metrics_port:
+            serve_metrics(METRICS, self.counters, self.address[0],
+                          self.metrics_port)
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        try:
+            while not self.stopping and self.pids_alive():
+                time.sleep(self.stats_interval or 1)
+                if self.stats_interval and not self.stopping:
+                    self.print_stats()
+        finally:
+            self.shutdown()
+            self.print_stats()
+        for pid, code in self.failed:
+            print('worker {} failed, exit code {}'.format(pid, code))
+        return 1 if self.failed else 0
+
+    def worker(self, worker):
+        """ Тело дочернего процесса """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(self.address)
+        server = self.server_class(
+            s, self.delay, counters=self.counters[worker],
+            **self.server_kwargs)
+        signal.signal(signal.SIGTERM, lambda *_: server.stop())
+        server.serve_forever()
+        s.close()
+        # os._exit не вызывает atexit - дописываем журнал сами
+        server.log.close()
+
+    def _request_stop(self, *_):
+        self.stopping = True
+
+    def pids_alive(self):
+        """ Забираем завершившиеся процессы, True - если кто-то еще жив """
+        for pid in list(self.pids):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                self.pids.remove(pid)
+                self.reap(pid, status)
+        return bool(self.pids)
+
+    def reap(self, pid, status):
+        """ Запоминаем процесс, завершившийся с ошибкой; SIGTERM при
+            остановке ошибкой не считается """
+        code = os.waitstatus_to_exitcode(status)
+        if code and not (self.stopping and code == -signal.SIGTERM):
+            self.failed.append((pid, code))
+
+    def shutdown(self):
+        """ Мягкая остановка: SIGTERM всем и ожидание завершения """
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.pids:
+            try:
+                _, status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                continue
+            self.reap(pid, status)
+        self.pids = []
+
+    def print_stats(self):
+        width = len(COUNTERS)
+        totals = [0] * width
+        print('{:<8}'.format('worker') + ''.join(
+            '{:>12}'.format(name) for name in COUNTERS))
+        for worker in range(self.workers):
+            row = self.counters[worker][RECEIVED:RECEIVED + width]
+            totals = [t + v for t, v in zip(totals, row)]
+            print('{:<8}'.format(worker) + ''.join(
+                '{:>12}'.format(v) for v in row))
+        print('{:<8}'.format('total') + ''.join(
+            '{:>12}'.format(v) for v in totals))
@@ -0,0 +1,84 @@
+""" Микробенчмарк кодека SNTPpack:
+    старый путь через строки bin()/rjust/str().split('.')
+    против struct.Struct + побитовой упаковки + pack_into в готовый буфер
+    и против заготовки ответа сервера (меняются только временные метки)
+
+./bench_codec.py -n 100000
+"""
+
+import argparse
+import struct
+import time
+import timeit
+
+from SNTPserver import NTP_PACKET, SNTPpack, SNTPserver
+
+
+def legacy_parse_first_byte(num):
+    b = bin(num)[2:].rjust(8, '0')
+    return int(b[:2], 2), int(b[2:5], 2), int(b[5:], 2)
+
+
+def legacy_num_to_bin(num, length):
+    return bin(num)[2:].rjust(length, '0')
+
+
+def legacy_convert_time_to_sntp(t):
+    sec, mill_sec = str(t + 2208988800).split('.')
+    mill_sec = float('0.{}'.format(mill_sec)) * 2 ** 32
+    return int(sec), int(mill_sec)
+
+
+def legacy_parse(data):
+    size = struct.calcsize('!4B3L4Q')
+    unpacked = struct.unpack('!4B3L4Q', data[:size])
+    li, vn, mode = legacy_parse_first_byte(unpacked[0])
+    ref = struct.unpack('!Q', data[16:24])[0]
+    transmit = struct.unpack('!Q', data[40:48])[0]
+    return li, vn, mode, ref, transmit
+
+
+def legacy_create(pack):
+    first_byte = int('{}{}{}'.format(
+        legacy_num_to_bin(pack.LI, 2),
+        legacy_num_to_bin(pack.VN, 3),
+        legacy_num_to_bin(pack.mode, 3)), 2)
+    transmit = legacy_convert_time_to_sntp(time.time() + pack.delay)
+    recive = legacy_convert_time_to_sntp(pack.recive_timestamp)
+    return struct.pack(
+        '!4B3L2LQ4L', first_byte, pack.stratum, pack.poll, pack.precision,
+        pack.root_delay, pack.root_dispersion, pack.ref_id, 0, 0,
+        pack.originate_timestamp, *recive, *transmit)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SNTPpack codec benchmark')
+    parser.add_argument('-n', '--number', type=int, default=100000,
+                        help='Iterations per case')
+    return parser.parse_args().__dict__
+
+
+def bench(number: int):
+    request = SNTPpack(mode=3, recive_time=time.time()).create_package()
+    response = SNTPpack(delay=5, originate_time=1 << 60,
+                        recive_time=time.time())
+    parsed = SNTPpack()
+    buffer = bytearray(NTP_PACKET.size)
+    server = SNTPserver(None, 5, batch_size=0)
+    now = time.time()
+
+    cases = (
+        ('parse  legacy', lambda: legacy_parse(request)),
+        ('parse  struct', lambda: parsed.parse_package(request)),
+        ('create legacy', lambda: legacy_create(response)),
+        ('create struct', lambda: response.create_package()),
+        ('create into  ', lambda: response.create_package(buffer)),
+        ('template     ', lambda: server.prepare_response(request, now)),
+    )
+    for name, case in cases:
+        spent = min(timeit.repeat(case, number=number, repeat=3))
+        print('{} {:8.3f} us/op'.format(name, spent / number * 1e6))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
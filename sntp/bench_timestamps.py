@@ -0,0 +1,72 @@
+""" Бенчмарк расхождения времени приема: метка ядра (SO_TIMESTAMPNS)
+против time.time() в пользовательском пространстве.
+Отправитель шлет пачки по --burst датаграмм, приемник вычитывает их
+так же, как SNTPserver.add_task; чем дальше датаграмма в очереди сокета,
+тем сильнее user-space метка отстает от момента прихода пакета.
+
+./bench_timestamps.py -n 20000 -b 64
+"""
+
+import argparse
+import select
+import socket
+import time
+
+from SNTPserver import (NTP_PACKET, SNTPpack, enable_kernel_stamps,
+                        kernel_stamp)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Kernel vs user-space receive timestamp skew')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Datagrams to send')
+    parser.add_argument('-b', '--burst', type=int, default=64,
+                        help='Datagrams per burst')
+    return parser.parse_args().__dict__
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench(number: int, burst: int):
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('localhost', 0))
+    receiver.setblocking(False)
+    option, anc_size = enable_kernel_stamps(receiver)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.connect(receiver.getsockname())
+
+    packet = SNTPpack(mode=3).create_package()
+    buffer = bytearray(NTP_PACKET.size)
+    skews = []
+    while len(skews) < number:
+        for _ in range(burst):
+            sender.send(packet)
+        select.select([receiver], [], [], 1)
+        while True:
+            try:
+                _, ancdata, _, _ = receiver.recvmsg_into([buffer], anc_size)
+            except BlockingIOError:
+                break
+            now = time.time()
+            stamp = kernel_stamp(ancdata, option)
+            if stamp is not None:
+                skews.append(now - stamp)
+    sender.close()
+    receiver.close()
+
+    if not skews:
+        print('no kernel timestamps received')
+        return
+    skews.sort()
+    print('datagrams: {} burst: {}'.format(len(skews), burst))
+    print('user - kernel p50: {:.1f} us p99: {:.1f} us max: {:.1f} us'.format(
+        percentile(skews, 0.50) * 1e6,
+        percentile(skews, 0.99) * 1e6,
+        skews[-1] * 1e6))
+
+
+if __name__ == "__main__":
+    bench(**parse_args())
@@ -0,0 +1,99 @@
+""" Локальный генератор нагрузки для SNTP-сервера.
+Держит в полете до --window запросов с одного неблокирующего сокета,
+измеряет число ответов в секунду и задержку (p50/p99).
+Время отправки кладется в transmit_timestamp запроса, сервер возвращает
+его в originate_timestamp ответа - по нему и считаем задержку.
+
+./load_gen.py -p 1234 -n 100000 -w 256
+"""
+
+import argparse
+import select
+import socket
+import time
+
+from SNTPserver import NTP_PACKET, SNTPpack, sntp_to_time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='SNTP load generator')
+    parser.add_argument('--host', type=str, default='localhost',
+                        help='Server host')
+    parser.add_argument('-p', '--port', type=int, default=123,
+                        help='Server port')
+    parser.add_argument('-n', '--number', type=int, default=10000,
+                        help='Total requests')
+    parser.add_argument('-w', '--window', type=int, default=64,
+                        help='Requests in flight')
+    parser.add_argument('-t', '--timeout', type=float, default=1.0,
+                        help='Give up after this many idle seconds')
+    return parser.parse_args().__dict__
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def load(host: str, port: int, number: int, window: int, timeout: float):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((host, port))
+    s.setblocking(False)
+
+    request = SNTPpack(mode=3)  # 3 - клиент
+    packet = bytearray(NTP_PACKET.size)
+    reply = SNTPpack()
+    reply_buffer = bytearray(1024)
+    latencies = []
+    sent = lost = 0
+    in_flight = 0
+
+    started = time.time()
+    while len(latencies) + lost < number:
+        while in_flight < window and sent < number:
+            # create_package проставляет текущее время в transmit_timestamp
+            request.create_package(packet)
+            try:
+                s.send(packet)
+            except (BlockingIOError, ConnectionError):
+                break
+            sent += 1
+            in_flight += 1
+
+        ready, _, _ = select.select([s], [], [], timeout)
+        if not ready:
+            # все что в полете считаем потерянным
+            lost += in_flight
+            in_flight = 0
+            continue
+        while True:
+            try:
+                nbytes = s.recv_into(reply_buffer)
+            except (BlockingIOError, ConnectionError):
+                break
+            now = time.time()
+            if nbytes < NTP_PACKET.size:
+                continue
+            reply.parse_package(reply_buffer)
+            latencies.append(now - sntp_to_time(reply.originate_timestamp))
+            in_flight -= 1
+    spent = time.time() - started
+    s.close()
+
+    latencies.sort()
+    print('requests: {} replies: {} lost: {}'.format(
+        sent, len(latencies), lost))
+    print('rate: {:.0f} replies/s'.format(len(latencies) / spent))
+    print('latency p50: {:.3f} ms p99: {:.3f} ms max: {:.3f} ms'.format(
+        percentile(latencies, 0.50) * 1e3,
+        percentile(latencies, 0.99) * 1e3,
+        percentile(latencies, 1.0) * 1e3))
+
+
+if __name__ == "__main__":
+    try:
+        load(**parse_args())
+    except KeyboardInterrupt:
+        print('\nTerminated.')
+        exit()
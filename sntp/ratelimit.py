@@ -0,0 +1,124 @@
+""" Ограничение частоты запросов по адресу клиента (token bucket).
+
+Таблица - открытая адресация с линейным пробированием по упакованному
+IPv4-адресу (int), данные лежат в трех плоских массивах array:
+    keys   'Q' - адрес + 1 (0 - пустая ячейка; 255.255.255.255 + 1 в
+                 32 бита уже не влезает)
+    tokens 'f' - остаток жетонов
+    stamps 'd' - время последнего обращения
+Итого 20 байт на ячейку: таблица на 2**20 ячеек (хватает на 1M
+источников) занимает 20 МиБ и больше не растет. Если среди PROBE ячеек
+для нового адреса нет свободной, вытесняется та из них, к которой дольше
+всего не обращались (приближенный LRU в пределах окна пробирования).
+Проверка одного адреса - O(PROBE) без выделения памяти. Ячейка - старшие
+биты 32-битного произведения на HASH_MUL: младшие зависят только от
+младших битов адреса, и адреса, различающиеся старшими октетами,
+вытесняли бы друг друга из одного окна пробирования.
+
+./ratelimit.py - замер скорости и памяти на 1M разных адресов и
+проверка, что адреса, различающиеся только первым октетом, ограничены
+"""
+
+import array
+import socket
+import time
+
+ALLOW, KOD, DROP = range(3)
+PROBE = 8
+HASH_MUL = 2654435761  # мультипликативный хеш Кнута
+
+
+def pack_ipv4(ip):
+    """ '10.0.0.1' -> int """
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+class RateLimiter:
+    """ rate - жетонов в секунду на адрес, burst - размер ведра.
+        С kod=True первый отказ после разрешенного запроса возвращает KOD
+        (стоит одного жетона штрафа), последующие - DROP, чтобы сами
+        KoD-ответы не превращались в отражение флуда """
+    def __init__(self, rate, burst, kod=False, capacity=1 << 20) -> None:
+        if capacity & (capacity - 1):
+            raise ValueError('capacity must be a power of two')
+        self.rate = rate
+        self.burst = burst
+        self.kod = kod
+        self.mask = capacity - 1
+        self.shift = 32 - capacity.bit_length() + 1
+        self.keys = array.array('Q', bytes(8 * capacity))
+        self.tokens = array.array('f', bytes(4 * capacity))
+        self.stamps = array.array('d', bytes(8 * capacity))
+
+    def memory(self):
+        """ Размер таблицы в байтах """
+        return sum(a.itemsize * len(a)
+                   for a in (self.keys, self.tokens, self.stamps))
+
+    def check(self, ip, now):
+        """ ip - адрес в виде int, возвращает ALLOW, KOD или DROP """
+        key = ip + 1
+        keys = self.keys
+        mask = self.mask
+        slot = ((key * HASH_MUL) & 0xFFFFFFFF) >> self.shift
+        victim = slot
+        oldest = None
+        for _ in range(PROBE):
+            found = keys[slot]
+            if found == key:
+                return self._take(slot, now)
+            if found == 0:
+                victim = slot
+                break
+            stamp = self.stamps[slot]
+            if oldest is None or stamp < oldest:
+                oldest, victim = stamp, slot
+            slot = (slot + 1) & mask
+        keys[victim] = key
+        self.tokens[victim] = self.burst - 1
+        self.stamps[victim] = now
+        return ALLOW
+
+    def _take(self, slot, now):
+        tokens = min(self.burst, self.tokens[slot] +
+                     (now - self.stamps[slot]) * self.rate)
+        self.stamps[slot] = now
+        if tokens >= 1:
+            self.tokens[slot] = tokens - 1
+            return ALLOW
+        if tokens >= 0 and self.kod:
+            self.tokens[slot] = tokens - 1
+            return KOD
+        self.tokens[slot] = tokens
+        return DROP
+
+
+def bench(sources=1 << 20):
+    limiter = RateLimiter(rate=1, burst=4)
+    ips = [(i * 7919) & 0xFFFFFFFF for i in range(sources)]
+    now = time.time()
+    started = time.perf_counter()
+    for ip in ips:
+        limiter.check(ip, now)
+    spent = time.perf_counter() - started
+    print('sources: {} table: {:.1f} MiB'.format(
+        sources, limiter.memory() / 2 ** 20))
+    print('check: {:.0f} /s ({:.2f} us/op)'.format(
+        sources / spent, spent / sources * 1e6))
+
+
+def check_spread(sources=16, requests=50, burst=2):
+    """ Адреса 1.0.3.4 ... 16.0.3.4 разом: каждому - не больше burst """
+    limiter = RateLimiter(rate=1, burst=burst)
+    ips = [pack_ipv4('{}.0.3.4'.format(i + 1)) for i in range(sources)]
+    now = time.time()
+    allowed = sum(limiter.check(ip, now) == ALLOW
+                  for _ in range(requests) for ip in ips)
+    print('spread sources: allowed {} of {}'.format(
+        allowed, sources * requests))
+    assert allowed == sources * burst, allowed
+
+
+if __name__ == "__main__":
+    check_spread()
+    bench()
@@ -3,6 +3,20 @@
     означающим число секунд, на которое должны обманывать клиентов,
     по умолчанию 0
 --port, -p - порт, который слушаем, по умолчанию 123
+--backend  - threads (select в отдельном потоке, по умолчанию)
+    или asyncio (DatagramProtocol в цикле событий)
+--workers N - запустить N процессов на одном порту (SO_REUSEPORT),
+    при остановке выводится сводная статистика по процессам
+--stats N  - в режиме --workers печатать статистику каждые N секунд
+--rate R --burst B - ограничить каждый адрес R запросами в секунду
+    (ведро на B запросов), лишние отбрасываются
+--kod      - на первый лишний запрос отвечать Kiss-o'-Death "RATE"
+--kernel-timestamps - время приема брать из ядра (SO_TIMESTAMPNS, Linux,
+    только --backend threads)
+--metrics-port N - отдавать метрики Prometheus на http://localhost:N/metrics
+--log-sample N - выводить только каждое N-е сообщение о подключении
+--log-window S - вместо сообщений о каждом подключении раз в S секунд
+    выводить сводку по клиентам
 
 ./sntp.py -d 5
 сервер в ответе добавляет 5 секунд к текущему времени
@@ -13,31 +27,81 @@
 import argparse
 import socket
 
-from SNTPserver import SNTPserver
+from SNTPasync import AsyncSNTPserver
+from SNTPserver import METRICS, SNTPserver, kernel_stamp_option
+from SNTPworkers import SNTPworkers
+from ratelimit import RateLimiter
+from common.buflog import BufferedLog
+from common.metrics import serve_metrics
+
+BACKENDS = {
+    'threads': SNTPserver,
+    'asyncio': AsyncSNTPserver,
+}
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description='SNTP experimental server')
     parser.add_argument('-d', '--delay', type=int, default=20.0,
                         help='Set delay')
-    parser.add_argument('-p', '--port', type=int, nargs=1, default=123,
+    parser.add_argument('-p', '--port', type=int, default=123,
                         help='Listen port')
-    return parser.parse_args().__dict__
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        default='threads', help='Server implementation')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Number of SO_REUSEPORT worker processes')
+    parser.add_argument('--stats', type=int, default=0,
+                        help='Print worker stats every N seconds')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Requests per second per client (0 - no limit)')
+    parser.add_argument('--burst', type=int, default=8,
+                        help='Rate limit bucket size')
+    parser.add_argument('--kod', action='store_true',
+                        help="Answer limited clients with KoD RATE")
+    parser.add_argument('--log-sample', type=int, default=1,
+                        help='Log one of N client requests')
+    parser.add_argument('--log-window', type=float, default=0,
+                        help='Aggregate client log over N seconds')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='Serve Prometheus metrics on this port')
+    parser.add_argument('--kernel-timestamps', action='store_true',
+                        help='Use SO_TIMESTAMPNS receive timestamps')
+    args = parser.parse_args()
+    if args.kernel_timestamps and args.backend != 'threads':
+        parser.error('--kernel-timestamps needs --backend threads')
+    if args.kernel_timestamps and kernel_stamp_option() is None:
+        parser.error('--kernel-timestamps is not supported on this '
+                     'platform')
+    return args.__dict__
+
 
+def start(delay: int, port: int, backend: str, workers: int, stats: int,
+          rate: float, burst: int, kod: bool, log_sample: int,
+          log_window: float, metrics_port: int, kernel_timestamps: bool):
+    limiter = RateLimiter(rate, burst, kod) if rate > 0 else None
+    log = BufferedLog(sample=log_sample, window=log_window)
+    options = {'limiter': limiter, 'log': log}
+    if kernel_timestamps:
+        options['kernel_stamps'] = True
+    if workers > 0:
+        pool = SNTPworkers(BACKENDS[backend], delay, 'localhost', port,
+                           workers, stats, metrics_port, **options)
+        return pool.run()
 
-def start(delay: int, port: int):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.bind(('localhost', port))
     s.settimeout(1)
 
-    sntp = SNTPserver(s, delay)
+    sntp = BACKENDS[backend](s, delay, **options)
+    if metrics_port:
+        serve_metrics(METRICS, [sntp.counters], 'localhost', metrics_port)
     sntp.run()
 
 
 if __name__ == "__main__":
     try:
         args = parse_args()
-        start(**args)
+        exit(start(**args))
 
     except KeyboardInterrupt:
         print('\nTerminated.')
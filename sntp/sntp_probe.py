@@ -0,0 +1,193 @@
+""" Массовый опрос SNTP-серверов с одного неблокирующего сокета.
+
+./sntp_probe.py time1:123 time2:123 -c 10
+    по 10 запросов каждому серверу, до --window запросов в полете
+./sntp_probe.py localhost:1234 -c 10000
+    нагрузочная проверка одного сервера
+
+Ответ сопоставляется с запросом по originate_timestamp (сервер возвращает
+в нём наш transmit_timestamp). Смещение и задержка считаются для всех
+ответов разом (векторно через NumPy, если он установлен):
+    offset = ((T2 - T1) + (T3 - T4)) / 2
+    delay  = (T4 - T1) - (T3 - T2)
+Метки хранятся целыми в единицах NTP (2**-32 с) относительно первой
+отправленной, чтобы влезть в int64 без потери точности.
+
+Ответы, которым нельзя верить (RFC 4330, 5): Kiss-o'-Death (stratum 0),
+LI=3 (часы сервера не синхронизированы) и нулевой transmit_timestamp -
+в замер не идут и считаются отдельно, в столбце rejected.
+"""
+
+import argparse
+import collections
+import select
+import socket
+import time
+
+from SNTPserver import (NTP_FRAC, NTP_PACKET, NTP_TIMESTAMP, SNTPpack,
+                        TRANSMIT_OFFSET, time_to_sntp)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LEAP_ALARM = 3  # LI: часы сервера не синхронизированы
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk SNTP probe')
+    parser.add_argument('servers', nargs='+',
+                        help='Servers as host[:port]')
+    parser.add_argument('-c', '--count', type=int, default=4,
+                        help='Requests per server')
+    parser.add_argument('-w', '--window', type=int, default=256,
+                        help='Requests in flight')
+    parser.add_argument('-t', '--timeout', type=float, default=1.0,
+                        help='Reply timeout, seconds')
+    return parser.parse_args().__dict__
+
+
+def resolve(server):
+    host, _, port = server.partition(':')
+    info = socket.getaddrinfo(host, int(port or 123), socket.AF_INET,
+                              socket.SOCK_DGRAM)
+    return info[0][4]
+
+
+def unusable(reply):
+    """ KoD, несинхронизированный сервер или пустое время отправки """
+    return reply.stratum == 0 or reply.LI == LEAP_ALARM or \
+        reply.transmit_timestamp == 0
+
+
+def probe(addresses, count, window, timeout):
+    """ Возвращает (номер сервера, T1, T2, T3, T4) для каждого ответа и
+        число отброшенных ответов по серверам """
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setblocking(False)
+    by_addr = {addr: i for i, addr in enumerate(addresses)}
+    queue = [i for _ in range(count) for i in range(len(addresses))]
+    queue.reverse()
+
+    request = bytearray(SNTPpack(mode=3).create_package())
+    reply = SNTPpack()
+    reply_buffer = bytearray(1024)
+    pending = {}  # originate -> номер сервера
+    deadlines = collections.deque()  # (срок, originate) в порядке отправки
+    last = 0
+    samples = []
+    rejected = [0] * len(addresses)
+
+    while queue or pending:
+        while queue and len(pending) < window:
+            server = queue[-1]
+            # transmit_timestamp должен быть уникален - по нему ищем ответ
+            t1 = max(time_to_sntp(time.time()), last + 1)
+            NTP_TIMESTAMP.pack_into(request, TRANSMIT_OFFSET, t1)
+            try:
+                s.sendto(request, addresses[server])
+            except BlockingIOError:
+                break
+            queue.pop()
+            pending[t1] = server
+            deadlines.append((time.time() + timeout, t1))
+            last = t1
+
+        # не ответившие вовремя считаем потерянными и освобождаем окно
+        now = time.time()
+        while deadlines and deadlines[0][0] <= now:
+            pending.pop(deadlines.popleft()[1], None)
+        wait = deadlines[0][0] - now if deadlines else 0
+        ready, _, _ = select.select([s], [], [], wait)
+        if not ready:
+            continue
+        while True:
+            try:
+                nbytes, addr = s.recvfrom_into(reply_buffer)
+            except (BlockingIOError, ConnectionError):
+                break
+            t4 = time_to_sntp(time.time())
+            if nbytes < NTP_PACKET.size:
+                continue
+            reply.parse_package(reply_buffer)
+            server = pending.pop(reply.originate_timestamp, None)
+            if server is None or by_addr.get(addr) != server:
+                continue
+            if unusable(reply):
+                rejected[server] += 1
+                continue
+            samples.append((server, reply.originate_timestamp,
+                            reply.recive_timestamp, reply.transmit_timestamp,
+                            t4))
+    s.close()
+    return samples, rejected
+
+
+def compute(samples):
+    """ Смещение и задержка (в секундах) для всех ответов """
+    if not samples:
+        return [], [], []
+    base = min(sample[1] for sample in samples)
+    servers = [sample[0] for sample in samples]
+    stamps = [[t - base for t in sample[1:]] for sample in samples]
+    if np is not None:
+        t1, t2, t3, t4 = np.array(stamps, dtype=np.int64).T
+        offset = ((t2 - t1) + (t3 - t4)) / 2 / NTP_FRAC
+        delay = ((t4 - t1) - (t3 - t2)) / NTP_FRAC
+        return np.array(servers), offset, delay
+    offset = [((t2 - t1) + (t3 - t4)) / 2 / NTP_FRAC
+              for t1, t2, t3, t4 in stamps]
+    delay = [((t4 - t1) - (t3 - t2)) / NTP_FRAC
+             for t1, t2, t3, t4 in stamps]
+    return servers, offset, delay
+
+
+def select_server(values, servers, server):
+    if np is not None:
+        return values[servers == server]
+    return [v for v, s in zip(values, servers) if s == server]
+
+
+def percentiles(values, qs=(50, 90, 99)):
+    if np is not None:
+        return np.percentile(values, qs) if len(values) else [0.0] * len(qs)
+    values = sorted(values)
+    if not values:
+        return [0.0] * len(qs)
+    return [values[min(len(values) - 1, int(len(values) * q / 100))]
+            for q in qs]
+
+
+def report(names, count, rejected, servers, offset, delay):
+    print('{:<24}{:>6}{:>9}{:>6}{:>12}{:>12}{:>12}{:>12}'.format(
+        'server', 'ok', 'rejected', 'lost', 'offset p50', 'delay p50',
+        'delay p90', 'delay p99'))
+    rows = [(name, rejected[i], select_server(offset, servers, i),
+             select_server(delay, servers, i))
+            for i, name in enumerate(names)]
+    if len(names) > 1:
+        rows.append(('all', sum(rejected), offset, delay))
+    for name, dropped, server_offset, server_delay in rows:
+        expected = count * (len(names) if name == 'all' else 1)
+        d50, d90, d99 = percentiles(server_delay)
+        o50, = percentiles(server_offset, (50,))
+        print('{:<24}{:>6}{:>9}{:>6}{:>10.3f}ms{:>10.3f}ms{:>10.3f}ms'
+              '{:>10.3f}ms'.format(
+                  name, len(server_delay), dropped,
+                  expected - len(server_delay) - dropped,
+                  o50 * 1e3, d50 * 1e3, d90 * 1e3, d99 * 1e3))
+
+
+def main(servers, count, window, timeout):
+    addresses = [resolve(server) for server in servers]
+    samples, rejected = probe(addresses, count, window, timeout)
+    report(servers, count, rejected, *compute(samples))
+
+
+if __name__ == "__main__":
+    try:
+        main(**parse_args())
+    except KeyboardInterrupt:
+        print('\nTerminated.')
+        exit()